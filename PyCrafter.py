@@ -1,6 +1,11 @@
 import usb.core
 import usb.util
 import time
+import struct
+import hashlib
+import multiprocessing
+import threading
+import queue
 import numpy
 import sys
 
@@ -23,7 +28,7 @@ def bitstobytes(a):
     if len(a) % 8 != 0:
         padding = 8 - len(a) % 8
         a = '0' * padding + a
-    for i in range(len(a) / 8):
+    for i in range(len(a) // 8):
         bytelist.append(int(a[8 * i:8 * (i + 1)], 2))
 
     bytelist.reverse()
@@ -31,20 +36,120 @@ def bitstobytes(a):
     return bytelist
 
 
-##function that encodes a 8 bit numpy array matrix as a enhanced run lenght encoded string of bits
+##function that turns one binary pattern into a (rows, columns) uint8 array of 0s and 1s. Patterns can be
+##boolean, integer valued 0/1, or bit packed along the rows as by numpy.packbits (rows, columns / 8)
 
-def mergeimages(images):
-    mergedimage = numpy.zeros((1080, 1920, 3), dtype='uint8')
+def bitplane(image, shape=(1080, 1920), check=True):
+    image = numpy.asarray(image)
+    height, width = shape
+    if image.shape == (height, width // 8) and image.dtype == numpy.uint8 and width % 8 == 0:
+        return numpy.unpackbits(image, axis=-1)
+    if image.shape != (height, width):
+        raise ValueError('pattern has shape ' + str(image.shape) + ', expected ' + str((height, width)))
+    if image.dtype == bool:
+        return image.view('uint8')
+    if check and (image.min() < 0 or image.max() > 1):
+        raise ValueError('patterns must only contain 0 and 1')
+    return image.astype('uint8', copy=False)
+
+
+##generator that packs binary patterns into 24 bit frames, 24 patterns per frame: patterns 0-7 go in
+##the blue byte, 8-15 in green and 16-23 in red. images is an (N, rows, columns) array, which is
+##validated once up front, or any iterable of single patterns, validated as they arrive. Each plane is
+##shifted into a reused buffer and or'ed into its colour byte, so only one frame and one pattern are held.
+
+def packimages(images, shape=(1080, 1920)):
+    height, width = shape
+    check = True
+    if isinstance(images, numpy.ndarray) and images.ndim == 3:
+        if images.shape[1:] == (height, width) and images.dtype != bool:
+            if images.min() < 0 or images.max() > 1:
+                raise ValueError('patterns must only contain 0 and 1')
+        check = False
+
+    shifted = numpy.empty((height, width), dtype='uint8')
+    channels = numpy.zeros((3, height, width), dtype='uint8')
+    count = 0
+
+    for image in images:
+        plane = bitplane(image, shape, check)
+        numpy.left_shift(plane, count % 8, out=shifted)
+        channel = channels[2 - (count % 24) // 8]
+        numpy.bitwise_or(channel, shifted, out=channel)
+        count += 1
+
+        if count % 24 == 0:
+            yield numpy.ascontiguousarray(channels.transpose(1, 2, 0))
+            channels[:] = 0
+
+    if count % 24 != 0:
+        yield numpy.ascontiguousarray(channels.transpose(1, 2, 0))
+
+
+##generator that splits a sequence of patterns into the groups of 24 that make up each frame
+
+def patterngroups(images, size=24):
+    group = []
+    for image in images:
+        group.append(image)
+        if len(group) == size:
+            yield group
+            group = []
+
+    if group:
+        yield group
+
+
+##function that packs value into a little endian field of size bytes, raising ValueError if it does not fit
 
-    for i in range(len(images)):
-        if i < 8:
-            mergedimage[:, :, 2] = mergedimage[:, :, 2] + images[i] * (2 ** i)
-        if i > 7 and i < 16:
-            mergedimage[:, :, 1] = mergedimage[:, :, 1] + images[i] * (2 ** (i - 8))
-        if i > 15 and i < 24:
-            mergedimage[:, :, 0] = mergedimage[:, :, 0] + images[i] * (2 ** (i - 16))
+def fieldbytes(value, size, name):
+    value = int(value)
+    if not 0 <= value < 1 << (8 * size):
+        raise ValueError(name + ' ' + str(value) + ' does not fit in ' + str(size) + ' bytes')
+    return value.to_bytes(size, 'little')
 
-    return mergedimage
+
+##function that raises ValueError unless count patterns were given for num exposures, so the lut never
+##declares patterns that were not defined and no pattern is dropped
+
+def checkcount(count, num):
+    if count != num:
+        raise ValueError(str(count) + ' patterns given for ' + str(num) + ' exposures')
+
+
+##function that packs a group of patterns into bit-planes (rows, columns / 8), an eighth of the memory
+##of 0/1 images and cheap to send to other processes. Patterns that are already packed are kept as they are
+
+def packgroup(images, shape=(1080, 1920)):
+    packed = []
+    for image in images:
+        if isinstance(image, numpy.ndarray) and image.shape == (shape[0], shape[1] // 8) and image.dtype == numpy.uint8:
+            packed.append(image)
+        else:
+            packed.append(numpy.packbits(bitplane(image, shape), axis=-1))
+
+    return packed
+
+
+##function that hashes a group of patterns, used as the key of encoded frames. Patterns are hashed as
+##packed bit-planes, so the same frame gives the same key whether given as bool, 0/1 or packed bits
+
+def groupkey(images, shape=(1080, 1920)):
+    key = hashlib.blake2b(digest_size=20)
+    key.update(struct.pack('<HHH', shape[0], shape[1], len(images)))
+    for image in packgroup(images, shape):
+        key.update(numpy.ascontiguousarray(image).tobytes())
+
+    return key.hexdigest()
+
+
+##function that merges up to 24 binary patterns into a single 24 bit frame
+
+def mergeimages(images):
+    for mergedimage in packimages(images[:24]):
+        return mergedimage
+
+    return numpy.zeros((1080, 1920, 3), dtype='uint8')
 
 
 def encode(image):
@@ -209,79 +314,739 @@ def encode(image):
     return bitstring, bytecount
 
 
-##a dmd controller class
+##function returning, for each pixel of a boolean (rows, columns) mask, the column of the first False
+##at or after it (the number of columns if there is none)
 
-class dmd():
-    def __init__(self):
-        self.dev = usb.core.find(idVendor=0x0451, idProduct=0xc900)
+def runends(mask):
+    columns = mask.shape[-1]
+    ends = numpy.where(mask, numpy.int16(columns), numpy.arange(columns, dtype='int16'))
+    return numpy.minimum.accumulate(ends[..., ::-1], axis=-1)[..., ::-1]
 
-        self.dev.set_configuration()
 
-        self.ans = []
+##functions for a vectorised version of encode. The runs are found for the whole frame at once by
+##comparing the packed 24 bit pixels with their right and upper neighbours, the chains of runs are followed
+##in all rows at once and the encoded bytes are then written with numpy, so python only loops once per run
+##in the longest row. The output is byte for byte the same as encode (including row 0 being compared with
+##the last row). Where encode would fail (a literal run reaching the last column) the run stops one column
+##short, and where it would never return (an empty literal run in row 0) a single pixel is written instead.
 
-    ## standard usb command function
+##function returning the masks of pixels equal to the pixel above and to the right and the ends of the
+##copy, repeat and literal runs starting at each pixel
 
-    def command(self, mode, sequencebyte, com1, com2, data=None):
-        buffer = []
+def erle_runs(image):
+    height, width = image.shape[:2]
+    pixels = (image[:, :, 0].astype('uint32') << 16) | (image[:, :, 1].astype('uint32') << 8) | image[:, :, 2]
 
-        flagstring = ''
-        if mode == 'r':
-            flagstring += '1'
-        else:
-            flagstring += '0'
-        flagstring += '1000000'
-        buffer.append(bitstobytes(flagstring)[0])
-        buffer.append(sequencebyte)
-        temp = bitstobytes(convlen(len(data) + 2, 16))
-        buffer.append(temp[0])
-        buffer.append(temp[1])
-        buffer.append(com2)
-        buffer.append(com1)
+    above = pixels == numpy.roll(pixels, 1, axis=0)
+    right = numpy.zeros((height, width), dtype=bool)
+    right[:, :-1] = pixels[:, :-1] == pixels[:, 1:]
+    literal = ~(above | right)
+    literal[:, -1] = False
 
-        if len(buffer) + len(data) < 65:
+    return above, right, runends(above), runends(right), runends(literal)
+
+
+##function that creates the 48 byte header of an encoded frame
+
+def erle_header(width, height, size):
+    header = bytearray(b'Spld')
+    header += struct.pack('<HHI', width, height, size)
+    header += b'\xff' * 8
+    header += b'\x00' * 5  ## black curtain
+    header += b'\x02\x01'  ## enhanced rle
+    header += b'\x00' * 21
+
+    return header
+
+
+##kinds of the runs picked by erle_choose, a single pixel being a repeat of one pixel
+
+COPY, REPEAT, LITERAL, ENDLINE = 0, 1, 2, 3
+
+
+##function that picks the runs the encoder writes. Every pixel gets the kind of run starting there and the
+##column after it, then the chains from column 0 are followed in all rows at once. Returns the row, column,
+##kind and length of every run in stream order, with an ENDLINE run at the end of each row
 
-            for i in range(len(data)):
-                buffer.append(data[i])
+def erle_choose(image, runs):
+    height, width = image.shape[:2]
+    above, right, aboveends, rightends, literalends = runs
+    copyrows = above.all(axis=1)
+    copyrows[0] = False
+    rows = numpy.flatnonzero(~copyrows)
+    above, right = above[rows], right[rows]
+    columns = numpy.arange(width, dtype='int16')
 
-            for i in range(64 - len(buffer)):
-                buffer.append(0x00)
+    ## single pixels, then literal runs, repeats and copies from above in increasing priority. A column
+    ## past the end holds the end of line run, so the flat index of a run in these is its sort key. Rows
+    ## copied whole from the row above are one copy from column 0
+    literal = numpy.zeros(above.shape, dtype=bool)
+    literal[:, :-2] = ~(right[:, 1:-1] | above[:, 1:-1])
+    literal &= literalends[rows] - columns >= 2
+    copy = above.copy()
+    copy[rows == 0] = False
+
+    kinds = numpy.full((height, width + 1), ENDLINE, dtype='int8')
+    kinds[copyrows, 0] = COPY
+    rowkinds = numpy.where(literal & ~right, numpy.int8(LITERAL), numpy.int8(REPEAT))
+    rowkinds[copy] = COPY
+    kinds[rows, :-1] = rowkinds
+    nextcolumn = numpy.full((height, width + 1), width, dtype='int16')
+    nextcolumn[rows, :-1] = numpy.where(copy, aboveends[rows], numpy.where(right, rightends[rows] + 1,
+                                        numpy.where(literal, literalends[rows], columns + 1)))
+
+    ## the run each run is followed by, -1 at the end of the row
+    rowstarts = numpy.arange(height, dtype='int32') * (width + 1)
+    following = numpy.where(nextcolumn == width, -1, rowstarts[:, None] + nextcolumn).reshape(-1)
+
+    position = rowstarts
+    positions = [rowstarts + width]
+    while len(position):
+        positions.append(position)
+        position = following[position]
+        position = position[position >= 0]
+
+    keys = numpy.concatenate(positions)
+    keys.sort()
+    rows, starts = numpy.divmod(keys.astype('int64'), width + 1)
+    kind = kinds.reshape(-1)[keys]
+    length = nextcolumn.reshape(-1)[keys] - starts
+
+    return rows, starts, kind, length
+
+
+##function returning a boolean mask of size elements that is True from each start to start + length - 1.
+##The ranges must not overlap
+
+def covered(starts, lengths, size):
+    nonempty = lengths > 0
+    starts, lengths = starts[nonempty], lengths[nonempty]
+    mask = numpy.zeros(size + 1, dtype='int8')
+    mask[starts] = 1
+    mask[starts + lengths] -= 1
+    return numpy.cumsum(mask[:-1], dtype='int8').astype(bool)
+
+
+##function that encodes the rows of a frame, returning the encoded bytes as a uint8 array and the position
+##after the end of line bytes of each row. The pixels written follow each other in the same order in the
+##image and in the stream, so the headers of all runs are scattered into the output at once and the pixel
+##bytes fill the rest of it
+
+def erle_body(image, runs):
+    height, width = image.shape[:2]
+    rows, starts, kind, length = erle_choose(image, runs)
+
+    ## header: 00 01 count for copies, count for repeats, 00 count for literals and 00 00 for end of line
+    prefix = numpy.choose(kind, [2, 0, 1, 2])
+    counts = numpy.where(kind == ENDLINE, 0, 1 + (length >= 128))
+    headers = numpy.zeros((len(kind), 4), dtype='uint8')
+    headers[kind == COPY, 1] = 1
+    index = numpy.flatnonzero(counts)
+    headers[index, prefix[index]] = numpy.where(length[index] >= 128, (length[index] & 0x7f) | 0x80, length[index])
+    index = numpy.flatnonzero(counts == 2)
+    headers[index, prefix[index] + 1] = length[index] >> 7
+    headerlength = prefix + counts
+
+    ## pixels written: one for repeats, length for literals
+    pixelcount = numpy.where(kind == REPEAT, 1, 0)
+    pixelcount[kind == LITERAL] = length[kind == LITERAL]
+    index = numpy.flatnonzero(pixelcount)
+    written = covered(rows[index] * width + starts[index], pixelcount[index], height * width)
+
+    offsets = numpy.zeros(len(kind) + 1, dtype='int64')
+    numpy.cumsum(headerlength + 3 * pixelcount, out=offsets[1:])
+    body = numpy.empty(offsets[-1], dtype='uint8')
+
+    isheader = numpy.repeat(numpy.tile([True, False], len(kind)),
+                            numpy.stack((headerlength, 3 * pixelcount), axis=1).reshape(-1))
+    body[isheader] = headers[numpy.arange(4) < headerlength[:, None]]
+    body[~isheader] = numpy.take(image.reshape(-1, 3), numpy.flatnonzero(written), axis=0).reshape(-1)
+
+    return body, offsets[1:][kind == ENDLINE]
+
+
+##generator yielding the encoded rows of a frame, each ending with the end of line bytes
+
+def erle_rows(image, runs):
+    body, rowends = erle_body(image, runs)
+    start = 0
+    for end in rowends:
+        yield body[start:end].tobytes()
+        start = end
+
+
+##function that works out the size of the encoded frame without encoding it. Every pixel gets the column
+##the run starting there ends at and the bytes that run takes, then the chains of runs from column 0 are
+##followed in all rows at once. Rows copied whole from the row above are left out of this.
 
-            self.dev.write(1, buffer)
+def erle_size(image, runs):
+    height, width = image.shape[:2]
+    above, right, aboveends, rightends, literalends = runs
+    copyrows = above.all(axis=1)
+    copyrows[0] = False
+    rows = numpy.flatnonzero(~copyrows)
+    above, right = above[rows], right[rows]
+    columns = numpy.arange(width, dtype='int16')
 
+    ## single pixels, then literal runs, repeats and copies from above in increasing priority
+    nextcolumn = numpy.empty((len(rows), width + 1), dtype='int16')
+    nextcolumn[:, :-1] = columns + 1
+    nextcolumn[:, -1] = width
+    cost = numpy.zeros((len(rows), width + 1), dtype='int32')
+    cost[:, :-1] = 4
+
+    literal = numpy.zeros(above.shape, dtype=bool)
+    literal[:, :-2] = ~(right[:, 1:-1] | above[:, 1:-1])
+    n = literalends[rows] - columns
+    literal &= n >= 2
+    nextcolumn[:, :-1][literal] = literalends[rows][literal]
+    cost[:, :-1][literal] = 1 + (n[literal] >= 128) + 1 + 3 * n[literal]
+
+    n = rightends[rows] - columns + 1
+    nextcolumn[:, :-1][right] = rightends[rows][right] + 1
+    cost[:, :-1][right] = 1 + (n[right] >= 128) + 3
+
+    copy = above.copy()
+    copy[rows == 0] = False
+    n = aboveends[rows] - columns
+    nextcolumn[:, :-1][copy] = aboveends[rows][copy]
+    cost[:, :-1][copy] = 2 + 1 + (n[copy] >= 128)
+
+    index = numpy.arange(len(rows))
+    column = numpy.zeros(len(rows), dtype='int16')
+    total = 0
+    while len(index):
+        total += int(cost[index, column].sum())
+        column = nextcolumn[index, column]
+        running = column < width
+        index = index[running]
+        column = column[running]
+
+    copysize = 2 + 1 + (width >= 128)
+    size = 48 + total + copysize * (height - len(rows)) + 2 * height + 3
+
+    return size + (-size % 4)
+
+
+def erle_encode(image):
+    image = numpy.ascontiguousarray(image, dtype='uint8')
+    height, width = image.shape[:2]
+
+    bitstring = erle_header(width, height, 0)
+    bitstring += erle_body(image, erle_runs(image))[0].tobytes()
+
+    bitstring += b'\x00\x01\x00'
+    bitstring += b'\x00' * (-len(bitstring) % 4)
+
+    size = len(bitstring)
+    struct.pack_into('<I', bitstring, 8, size)
+
+    return bitstring, size
+
+
+##generator yielding an encoded frame in blocks as it is encoded, for uploading while encoding: the
+##header, with the size from erle_size already filled in, one block per row and the end of image bytes
+
+def erle_blocks(image, runs, size):
+    height, width = image.shape[:2]
+    yield erle_header(width, height, size)
+
+    count = 48
+    for row in erle_rows(image, runs):
+        count += len(row)
+        yield row
+
+    yield b'\x00\x01\x00' + b'\x00' * (size - count - 3)
+
+
+##function that starts streaming an encoded frame, returning its size and the generator of its blocks
+
+def erle_stream(image):
+    image = numpy.ascontiguousarray(image, dtype='uint8')
+    runs = erle_runs(image)
+
+    size = erle_size(image, runs)
+
+    return size, erle_blocks(image, runs, size)
+
+
+##function that packs (N, 3) bytes into uint32 pixels, which are the 3 bytes and a zero in a '<u4' array
+
+def packpixels(pixels):
+    pixels = pixels.astype('uint32')
+    return pixels[:, 0] | (pixels[:, 1] << 8) | (pixels[:, 2] << 16)
+
+
+##function that decodes an enhanced rle frame back into the (rows, columns, 3) 24 bit image, so encoded
+##frames can be checked before they are uploaded. Python only steps from one run header to the next; the
+##kinds, lengths and pixel positions of the runs are then read from the headers, checked and expanded into
+##the image with numpy. Raises ValueError if the header or stream is corrupt or the size does not match
+##the data.
+
+def erle_decode(data):
+    data = bytes(data)
+    if data[:4] != b'Spld' or len(data) < 48:
+        raise ValueError('not an encoded frame')
+    width, height, size = struct.unpack_from('<HHI', data, 4)
+    if data[25] != 0x02:
+        raise ValueError('not enhanced run length encoded')
+    if size != len(data):
+        raise ValueError('header size ' + str(size) + ' but ' + str(len(data)) + ' bytes')
+
+    headers = []
+    position = 48
+    ended = False
+    try:
+        while True:
+            headers.append(position)
+            control = data[position]
+            if control:  ## one pixel repeated
+                position += 5 if control & 0x80 else 4
+                continue
+            n = data[position + 1]
+            if n == 0:  ## end of line
+                position += 2
+            elif n == 1:  ## copy from the row above, a count of 0 ends the image
+                n = data[position + 2]
+                if n & 0x80:
+                    n = (n & 0x7f) | (data[position + 3] << 7)
+                    position += 1
+                position += 3
+                if n == 0:
+                    ended = True
+                    break
+            elif n & 0x80:  ## uncompressed pixels
+                position += 3 + 3 * ((n & 0x7f) | (data[position + 2] << 7))
+            else:
+                position += 2 + 3 * n
+    except IndexError:
+        pass
+    ## the end of image, or the header the stream ended in
+    headers.pop()
+
+    stream = numpy.frombuffer(data + bytes(4), dtype='uint8')
+    headers = numpy.array(headers, dtype='int64')
+    control, byte1, byte2, byte3 = (stream[headers + k].astype('int64') for k in range(4))
+    kind = numpy.where(control > 0, REPEAT, numpy.where(byte1 == 0, ENDLINE, numpy.where(byte1 == 1, COPY, LITERAL)))
+    ## the count starts after the 00 01, nothing or 00 in front of it, the pixels after the count
+    low = numpy.choose(kind, [byte2, control, byte1, 0])
+    high = numpy.choose(kind, [byte3, byte1, byte2, 0])
+    count = numpy.where(low & 0x80, (low & 0x7f) | (high << 7), low)
+    source = headers + numpy.choose(kind, [3, 1, 2, 2]) + (low >> 7)
+    if len(kind) and source[-1] > len(data):
+        kind, count, source = kind[:-1], count[:-1], source[:-1]
+
+    ## row and column each run starts at, the first error in the stream is reported
+    endline = kind == ENDLINE
+    copy = kind == COPY
+    literal = kind == LITERAL
+    row = numpy.cumsum(endline) - endline
+    total = numpy.zeros(len(kind) + 1, dtype='int64')
+    numpy.cumsum(count, out=total[1:])
+    column = total[:-1] - total[numpy.concatenate(([0], numpy.flatnonzero(endline) + 1))][row]
+
+    bad = numpy.flatnonzero((copy & (row == 0)) | (endline & (column != width)) |
+                            (~endline & ((row >= height) | (column + count > width))) |
+                            (source + numpy.choose(kind, [0, 3, 3 * count, 0]) > len(data)))
+    if len(bad):
+        k = bad[0]
+        if endline[k]:
+            raise ValueError('row ' + str(row[k]) + ' ends after ' + str(column[k]) + ' pixels')
+        if copy[k] and row[k] == 0:
+            raise ValueError('copy from above in the first row')
+        raise ValueError('run of ' + str(count[k]) + ' pixels overflows row ' + str(row[k]) + ' at column ' +
+                         str(column[k]))
+    if not ended:
+        raise ValueError('stream ends before the end of image')
+    if endline.sum() != height:
+        raise ValueError('image ends after ' + str(endline.sum()) + ' of ' + str(height) + ' rows')
+    if len(data) - position > 3:
+        raise ValueError(str(len(data) - position) + ' bytes after the end of image')
+
+    ## the image is built as uint32 pixels. The pixels of the repeats and literals are in the same order in
+    ## the stream as in the image, so each kind is one masked assignment
+    image = numpy.zeros(height * width, dtype='<u4')
+    first = row * width + column
+
+    index = numpy.flatnonzero(kind == REPEAT)
+    pixels = stream[source[index, None] + numpy.arange(3)]
+    image[covered(first[index], count[index], height * width)] = numpy.repeat(packpixels(pixels), count[index])
+
+    index = numpy.flatnonzero(literal)
+    pixels = stream[:len(data)][covered(source[index], 3 * count[index], len(data))]
+    image[covered(first[index], count[index], height * width)] = packpixels(pixels.reshape(-1, 3))
+
+    ## a copied pixel comes from the last row above it in its column that was not copied
+    image = image.reshape(height, width)
+    index = numpy.flatnonzero(copy)
+    if len(index) and (count[index] == width).all():
+        sourcerow = numpy.arange(height)
+        sourcerow[row[index]] = 0
+        image = image[numpy.maximum.accumulate(sourcerow)]
+    elif len(index):
+        copied = covered(first[index], count[index], height * width).reshape(height, width)
+        sourcerow = numpy.where(copied, 0, numpy.arange(height)[:, None])
+        numpy.maximum.accumulate(sourcerow, axis=0, out=sourcerow)
+        image = numpy.take_along_axis(image, sourcerow, axis=0)
+
+    return image.view('uint8').reshape(height, width, 4)[:, :, :3]
+
+
+##function that checks an encoded frame decodes to the merged patterns it was made from
+
+def erle_verify(encoded, size, images):
+    if size != len(encoded):
+        raise ValueError('frame size ' + str(size) + ' but ' + str(len(encoded)) + ' bytes')
+    decoded = erle_decode(encoded)
+    mismatch = numpy.flatnonzero((decoded != mergeimages(images)).any(axis=(1, 2)))
+    if len(mismatch):
+        raise ValueError('decoded frame differs from the patterns in ' + str(len(mismatch)) +
+                         ' rows, first row ' + str(mismatch[0]))
+
+
+##zero padding for the 64 byte hid reports
+
+ZEROS = bytes(64)
+
+
+##function that merges and encodes one group of patterns, run in the worker processes of prepareframes
+
+def prepareframe(images):
+    return erle_encode(mergeimages(images))
+
+
+##function telling whether prepareframes can start its pool. Its workers import the main module again, so
+##the program has to be run with python -m (giving __main__ a spec to import it by) and keep its own work
+##under if __name__ == '__main__'. An unguarded script would run again in every worker and fail as it
+##bootstraps, so interactive sessions and scripts run by path encode in this process instead
+
+def poolallowed():
+    return getattr(sys.modules['__main__'], '__spec__', None) is not None
+
+
+##function that merges and encodes every group of 24 patterns, returning (encoded bytes, size) for each
+##frame in upload order and the groupkey of each frame. Groups are packed to bit-planes and looked up in
+##the cache (if given) as they are read, then the misses are encoded in a pool of processes (all cores if
+##processes is None) when poolallowed, otherwise one after the other in this process. Frames whose key
+##matches the same frame of previous (a list of keys) are not prepared and returned as None. With verify
+##every frame is decoded and checked against its patterns before it is cached or returned. If num is
+##given the patterns are counted while they are grouped and ValueError is raised before anything is
+##encoded unless there are num of them.
+
+def prepareframes(images, processes=None, cache=None, previous=None, verify=False, num=None):
+    frames = []
+    keys = []
+    todo = []
+    groups = []
+    count = 0
+    for group in patterngroups(images):
+        count += len(group)
+        group = packgroup(group)
+        key = groupkey(group)
+        if verify:
+            groups.append(group)
+        frame = None
+        if previous is not None and len(keys) < len(previous) and previous[len(keys)] == key:
+            pass
+        elif cache is not None:
+            frame = cache.get(key)
+            if frame is None:
+                todo.append((len(frames), key, group))
         else:
-            for i in range(64 - len(buffer)):
-                buffer.append(data[i])
+            todo.append((len(frames), key, group))
+        frames.append(frame)
+        keys.append(key)
+
+    if num is not None:
+        checkcount(count, num)
+
+    if processes == 1 or len(todo) < 2 or not poolallowed():
+        encoded = map(prepareframe, [group for i, key, group in todo])
+        for (i, key, group), frame in zip(todo, encoded):
+            frames[i] = frame
+    else:
+        ## workers come from a forkserver, a fork of this process could inherit locks held by its other
+        ## threads (the controller's event loop and usb executor, Qt) and deadlock
+        with multiprocessing.get_context('forkserver').Pool(processes) as pool:
+            encoded = pool.imap(prepareframe, [group for i, key, group in todo])
+            for (i, key, group), frame in zip(todo, encoded):
+                frames[i] = frame
+
+    if verify:
+        for i, frame in enumerate(frames):
+            if frame is not None:
+                erle_verify(frame[0], frame[1], groups[i])
+
+    if cache is not None:
+        for i, key, group in todo:
+            cache.put(key, frames[i][0])
+
+    return frames, keys
+
+
+##generator that cuts an encoded frame, given as an iterable of blocks, into the bitmap packages sent by
+##bmpload: a 2 byte length then up to 504 bytes. There are size // 504 + 1 packages, the last one holding
+##size % 504 bytes. The same buffer is reused, so each package must be sent before the next is read.
+
+def bmppackets(blocks, size):
+    packnum = size // 504 + 1
+    payload = bytearray(504 + 2)
+    packet = memoryview(payload)
+    struct.pack_into('<H', payload, 0, 504)
 
-            self.dev.write(1, buffer)
+    i = 0
+    filled = 0
+    for block in blocks:
+        block = memoryview(block)
+        position = 0
+        while position < len(block):
+            if i < packnum - 1:
+                n = min(504 - filled, len(block) - position)
+            else:
+                n = min(size % 504 - filled, len(block) - position)
+                if n == 0:
+                    raise ValueError('encoded frame is longer than its size ' + str(size))
+            payload[2 + filled:2 + filled + n] = block[position:position + n]
+            filled += n
+            position += n
+            if filled == 504:
+                yield packet
+                i += 1
+                filled = 0
+
+    if i != packnum - 1 or filled != size % 504:
+        raise ValueError('encoded frame is shorter than its size ' + str(size))
+    struct.pack_into('<H', payload, 0, filled)
+    yield packet[:2 + filled]
+
+
+##function that puts an item on a queue, giving up if stop is set while waiting for space
+
+def putblock(blocks, item, stop):
+    while not stop.is_set():
+        try:
+            blocks.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+
+    return False
+
+
+##function run in the encoding thread of dmd.streamsequence. Frames are merged and encoded in upload
+##order (last frame first) and put on the blocks queue as (index, size), then blocks of at least blocksize
+##bytes, then None. Errors are put on the queue for the upload thread to raise.
+
+def streamframes(groups, keys, blocks, stop, cache=None, blocksize=4096):
+    try:
+        for i in range(len(groups) - 1, -1, -1):
+            frame = None
+            if cache is not None:
+                frame = cache.get(keys[i])
+            if frame is not None:
+                if not (putblock(blocks, (i, frame[1]), stop) and putblock(blocks, frame[0], stop)):
+                    return
+                putblock(blocks, None, stop)
+                continue
+
+            size, rows = erle_stream(mergeimages(groups[i]))
+            if not putblock(blocks, (i, size), stop):
+                return
+            encoded = bytearray()
+            block = bytearray()
+            for row in rows:
+                block += row
+                if len(block) >= blocksize:
+                    if not putblock(blocks, block, stop):
+                        return
+                    if cache is not None:
+                        encoded += block
+                    block = bytearray()
+            putblock(blocks, block, stop)
+            putblock(blocks, None, stop)
+            if cache is not None:
+                encoded += block
+                cache.put(keys[i], encoded)
+
+    except Exception as error:
+        putblock(blocks, error, stop)
+
+
+##generator yielding the blocks of one frame from the queue filled by streamframes
+
+def queueblocks(blocks):
+    while True:
+        block = blocks.get()
+        if block is None:
+            return
+        if isinstance(block, Exception):
+            raise block
+        yield block
+
+
+##exception raised when a bitmap upload fails. packet is the first package that may have failed (the
+##first after the last clean error check) and detected the package at which the failure was seen
+
+class DMDUploadError(Exception):
+    def __init__(self, packet, detected, message=''):
+        self.packet = packet
+        self.detected = detected
+        Exception.__init__(self, 'bitmap upload failed at package ' + str(packet) +
+                           ' (detected at ' + str(detected) + ') ' + message)
+
+
+class DMDUploadCancelled(DMDUploadError):
+    pass
+
+
+##dlp6500 limits in pattern mode: minimum exposure (us) by bit depth, the 24 bit exposure and dark time
+##fields and the number of patterns in the lut. A raw frame is the size an upload is estimated at before
+##the frames are encoded
+
+MINEXPOSURE = {1: 105, 2: 304, 3: 394, 4: 823, 5: 1215, 6: 1487, 7: 1998, 8: 4046}
+MAXTIME = 0xffffff
+MAXPATTERNS = 400
+RAWFRAME = 1080 * 1920 * 3 + 48
+
+
+class DMDTimingError(ValueError):
+    def __init__(self, problems):
+        self.problems = problems
+        ValueError.__init__(self, '; '.join(problems))
+
+
+##function that predicts how a sequence with the arguments of defsequence will run: the number of 24 bit
+##frames, the cycle time (us) and pattern rate (Hz) when not waiting for triggers, and the upload time (s)
+##at throughput (MB/s) for the encoded frame sizes, or for raw frames if the sizes are not known yet.
+##Settings the dmd cannot run, or a pattern rate below rate (Hz), are listed in problems
+
+def plansequence(exp, ti, dt, bitdepth=1, sizes=None, throughput=None, rate=None):
+    num = len(exp)
+    exp = numpy.asarray(exp, dtype='int64')
+    dt = numpy.asarray(dt, dtype='int64')
+    triggered = numpy.asarray(ti, dtype=bool)
+    bitdepth = numpy.broadcast_to(numpy.asarray(bitdepth, dtype='int64'), (num,))
+    problems = []
+
+    if num == 0:
+        problems.append('no patterns')
+    if num > MAXPATTERNS:
+        problems.append(str(num) + ' patterns, the lut holds ' + str(MAXPATTERNS))
+    if len(dt) != num or len(triggered) != num:
+        problems.append(str(num) + ' exposures, ' + str(len(triggered)) + ' trigger settings and ' +
+                        str(len(dt)) + ' dark times')
+        dt = numpy.resize(dt, num)
+        triggered = numpy.resize(triggered, num)
+
+    for j in numpy.flatnonzero((bitdepth < 1) | (bitdepth > 8))[:1]:
+        problems.append('pattern ' + str(j) + ' has bit depth ' + str(bitdepth[j]))
+    bitdepth = numpy.clip(bitdepth, 1, 8)
+    minimum = numpy.array([MINEXPOSURE[b] for b in range(1, 9)])[bitdepth - 1]
+    short = numpy.flatnonzero(exp < minimum)
+    if len(short):
+        j = short[0]
+        problems.append(str(len(short)) + ' exposures below the minimum, pattern ' + str(j) + ' ' + str(exp[j]) +
+                        ' us, bit depth ' + str(bitdepth[j]) + ' needs ' + str(minimum[j]) + ' us')
+    if num and (exp.max() > MAXTIME or dt.max() > MAXTIME):
+        problems.append('exposure or dark time above ' + str(MAXTIME) + ' us')
+    if num and dt.min() < 0:
+        problems.append('negative dark time')
+
+    cycletime = int(numpy.maximum(exp, minimum).sum() + numpy.maximum(dt, 0).sum())
+    patternrate = num * 1e6 / cycletime if cycletime else 0.0
+    if rate is not None and not triggered.any() and patternrate < rate * (1 - 1e-9):
+        problems.append('patterns run at ' + str(round(patternrate, 2)) + ' Hz, below ' + str(rate) + ' Hz')
+
+    frames = -(-int(bitdepth.sum()) // 24)
+    if sizes is not None and len(sizes) != frames:
+        problems.append(str(len(sizes)) + ' frame sizes for the ' + str(frames) + ' frames of ' + str(num) +
+                        ' patterns')
+    if sizes is None:
+        uploadbytes = frames * RAWFRAME
+    else:
+        uploadbytes = int(sum(size for size in sizes if size is not None))
+    uploadtime = uploadbytes / throughput / 1e6 if throughput else None
+
+    return {'patterns': num, 'frames': frames, 'triggered': bool(triggered.any()), 'cycletime': cycletime,
+            'rate': patternrate, 'uploadbytes': uploadbytes, 'estimated': sizes is None,
+            'uploadtime': uploadtime, 'problems': problems}
+
+
+##function that raises DMDTimingError if plansequence finds problems, returning the plan otherwise
+
+def checksequence(exp, ti, dt, bitdepth=1, sizes=None, throughput=None, rate=None):
+    plan = plansequence(exp, ti, dt, bitdepth, sizes, throughput, rate)
+    if plan['problems']:
+        raise DMDTimingError(plan['problems'])
+
+    return plan
 
-            buffer = []
 
-            j = 0
-            while j < len(data) - 58:
-                buffer.append(data[j + 58])
-                j = j + 1
-                if j % 64 == 0:
-                    self.dev.write(1, buffer)
+##a dmd controller class
 
-                    buffer = []
+class dmd():
+    def __init__(self, cache=None, dev=None):
+        self.cache = cache
+        if dev is None:
+            dev = usb.core.find(idVendor=0x0451, idProduct=0xc900)
+        self.dev = dev
 
-            if j % 64 != 0:
+        self.dev.set_configuration()
 
-                while j % 64 != 0:
-                    buffer.append(0x00)
-                    j = j + 1
+        self.ans = []
+        self.report = bytearray(64)
+        self.throughput = None
+
+        ## upload hooks for callers in other threads: progress is called with (bytes sent, frame size)
+        ## while a frame uploads, setting cancel stops the upload at the next package
+        self.progress = None
+        self.cancel = threading.Event()
 
-                self.dev.write(1, buffer)
+        ## what was last uploaded by defsequence / updatesequence: frame keys and sizes, the arguments of
+        ## each definepattern call and the (number of patterns, repeats) of the lut
+        self.sequence = None
 
-        self.ans = self.dev.read(0x81, 64)
+    ## standard usb command function
+
+    def command(self, mode, sequencebyte, com1, com2, data=None, reply=True):
+        if data is None:
+            data = b''
+        if isinstance(data, list):
+            data = bytes(data)
+        data = memoryview(data)
+        report = self.report
+
+        ## first report: flag byte (read bit, reply bit), sequence byte, length, command, then 58 data bytes
+        if mode == 'r':
+            flags = 0xc0
+        elif reply:
+            flags = 0x40
+        else:
+            flags = 0x00
+        struct.pack_into('<BBHBB', report, 0, flags, sequencebyte, len(data) + 2, com2, com1)
+        n = min(len(data), 58)
+        report[6:6 + n] = data[:n]
+        report[6 + n:] = ZEROS[6 + n:]
+        self.dev.write(1, report)
+
+        ## any remaining data follows in zero padded 64 byte reports
+        for start in range(58, len(data), 64):
+            n = min(len(data) - start, 64)
+            report[:n] = data[start:start + n]
+            report[n:] = ZEROS[n:]
+            self.dev.write(1, report)
+
+        if flags & 0x40:
+            self.ans = self.dev.read(0x81, 64)
 
     ## functions for checking error reports in the dlp answer
 
     def checkforerrors(self):
         self.command('r', 0x22, 0x01, 0x00, [])
         if self.ans[6] != 0:
-            print
-            self.ans[6]
+            print('dmd error', self.ans[6])
+
+        return self.ans[6]
 
         ## function printing all of the dlp answer
 
@@ -343,153 +1108,261 @@ class dmd():
         self.checkforerrors()
 
     def configurelut(self, imgnum, repeatnum):
-        img = convlen(imgnum, 11)
-        repeat = convlen(repeatnum, 32)
+        payload = struct.pack('<HI', imgnum, repeatnum)
 
-        string = repeat + '00000' + img
-
-        bytes = bitstobytes(string)
-
-        self.command('w', 0x00, 0x1a, 0x31, bytes)
+        self.command('w', 0x00, 0x1a, 0x31, payload)
         self.checkforerrors()
 
     def definepattern(self, index, exposure, bitdepth, color, triggerin, darktime, triggerout, patind, bitpos):
-        payload = []
-        index = convlen(index, 16)
-        index = bitstobytes(index)
-        for i in range(len(index)):
-            payload.append(index[i])
-
-        exposure = convlen(exposure, 24)
-        exposure = bitstobytes(exposure)
-        for i in range(len(exposure)):
-            payload.append(exposure[i])
-        optionsbyte = ''
-        optionsbyte += '1'
-        bitdepth = convlen(bitdepth - 1, 3)
-        optionsbyte = bitdepth + optionsbyte
-        optionsbyte = color + optionsbyte
-        if triggerin:
-            optionsbyte = '1' + optionsbyte
-        else:
-            optionsbyte = '0' + optionsbyte
-
-        payload.append(bitstobytes(optionsbyte)[0])
+        optionsbyte = (bool(triggerin) << 7) | (int(color, 2) << 4) | ((bitdepth - 1) << 1) | 1
 
-        darktime = convlen(darktime, 24)
-        darktime = bitstobytes(darktime)
-        for i in range(len(darktime)):
-            payload.append(darktime[i])
+        ## exposure and dark time are 3 byte fields, values that do not fit raise rather than being cut
+        payload = (fieldbytes(index, 2, 'pattern index') + fieldbytes(exposure, 3, 'exposure') +
+                   bytes([optionsbyte]) + fieldbytes(darktime, 3, 'dark time') + bytes([triggerout]) +
+                   fieldbytes((bitpos << 11) | patind, 2, 'pattern position'))
 
-        triggerout = convlen(triggerout, 8)
-        triggerout = bitstobytes(triggerout)
-        payload.append(triggerout[0])
+        self.command('w', 0x00, 0x1a, 0x34, payload)
+        self.checkforerrors()
 
-        patind = convlen(patind, 11)
-        bitpos = convlen(bitpos, 5)
-        lastbits = bitpos + patind
-        lastbits = bitstobytes(lastbits)
-        for i in range(len(lastbits)):
-            payload.append(lastbits[i])
+    ## led currents, 0-255 pwm of the red, green and blue drivers
 
-        self.command('w', 0x00, 0x1a, 0x34, payload)
+    def setledcurrents(self, red, green, blue):
+        self.command('w', 0x00, 0x0b, 0x01, [red, green, blue])
         self.checkforerrors()
 
-    def setbmp(self, index, size):
-        payload = []
+    ## led enables, set by hand rather than by the pattern colour of the sequence
 
-        index = convlen(index, 5)
-        index = '0' * 11 + index
-        index = bitstobytes(index)
-        for i in range(len(index)):
-            payload.append(index[i])
+    def setleds(self, red, green, blue):
+        self.command('w', 0x00, 0x1a, 0x07, [0x08 | (bool(blue) << 2) | (bool(green) << 1) | bool(red)])
+        self.checkforerrors()
 
-        total = convlen(size, 32)
-        total = bitstobytes(total)
-        for i in range(len(total)):
-            payload.append(total[i])
+    def setbmp(self, index, size):
+        payload = struct.pack('<HI', index, size)
 
         self.command('w', 0x00, 0x1a, 0x2a, payload)
         self.checkforerrors()
 
-    ## bmp loading function, divided in 56 bytes packages
-    ## max  hid package size=64, flag bytes=4, usb command bytes=2
-    ## size of package description bytes=2. 64-4-2-2=56
+    ## bmp loading function, divided in 504 byte packages sent as 64 byte hid reports
+    ## checkinterval=1 reads the reply and checks for errors after every package. Larger values stream
+    ## the packages without asking for a reply and check every checkinterval packages and at the end.
+    ## A failure raises DMDUploadError with the index of the first package that may have failed.
 
-    def bmpload(self, image, size):
+    def bmpload(self, image, size, checkinterval=1):
+        if isinstance(image, list):
+            image = bytearray(image)
 
-        t = time.clock()
+        self.bmpstream([image], size, checkinterval)
 
-        packnum = size / 504 + 1
+    ## same as bmpload, for an encoded frame given as an iterable of blocks of any length (as from
+    ## erle_stream), so the upload can start before the frame is fully encoded
 
-        counter = 0
+    def bmpstream(self, blocks, size, checkinterval=1):
 
-        for i in range(packnum):
-            if i % 100 == 0:
-                print
-                i, packnum
-            payload = []
-            if i < packnum - 1:
-                leng = convlen(504, 16)
-                bits = 504
-            else:
-                leng = convlen(size % 504, 16)
-                bits = size % 504
-            leng = bitstobytes(leng)
-            for j in range(2):
-                payload.append(leng[j])
-            for j in range(bits):
-                payload.append(image[counter])
-                counter += 1
-            self.command('w', 0x11, 0x1a, 0x2b, payload)
-
-            self.checkforerrors()
-        print
-        time.clock() - t
-
-    def defsequence(self, images, exp, ti, dt, to, rep):
+        t = time.perf_counter()
+
+        packnum = size // 504 + 1
+        checked = 0
+
+        for i, packet in enumerate(bmppackets(blocks, size)):
+            if self.cancel.is_set():
+                raise DMDUploadCancelled(checked, i, 'cancelled')
+            try:
+                self.command('w', 0x11, 0x1a, 0x2b, packet, reply=checkinterval == 1)
+            except usb.core.USBError as error:
+                raise DMDUploadError(i, i, str(error))
 
+            if (i + 1) % checkinterval == 0 or i == packnum - 1:
+                if self.checkforerrors() != 0:
+                    raise DMDUploadError(checked, i, 'error code ' + str(self.ans[6]))
+                checked = i + 1
+
+            if self.progress is not None and (i % 64 == 63 or i == packnum - 1):
+                self.progress(min((i + 1) * 504, size), size)
+
+        elapsed = time.perf_counter() - t
+        self.throughput = size / elapsed / 1e6
+        print('uploaded', size, 'bytes in', round(elapsed, 3), 's,', round(self.throughput, 3), 'MB/s')
+
+    ## plansequence at the throughput of the last upload
+
+    def plan(self, exp, ti, dt, sizes=None, rate=None):
+        return plansequence(exp, ti, dt, 1, sizes, self.throughput, rate)
+
+    ## encodes the patterns with prepareframes and uploads them as a sequence. processes encoding
+    ## processes are only used when the program was run with python -m and its work is under
+    ## if __name__ == '__main__' (see poolallowed), otherwise the frames are encoded in this process
+
+    def defsequence(self, images, exp, ti, dt, to, rep, processes=None, checkinterval=1, verify=False):
+
+        checksequence(exp, ti, dt)
         self.stopsequence()
+        self.sequence = None
 
-        arr = []
+        ## one exposure per pattern, so images can be a generator
+        num = len(exp)
 
-        for i in images:
-            arr.append(i)
+        print('encoding...')
+        frames, keys = prepareframes(images, processes, self.cache, verify=verify, num=num)
+        encodedimages = [frame[0] for frame in frames]
+        sizes = [frame[1] for frame in frames]
 
-        ##        arr.append(numpy.ones((1080,1920),dtype='uint8'))
+        patterns = []
+        for i in range(len(frames)):
+            for j in range(i * 24, min((i + 1) * 24, num)):
+                patterns.append((j, exp[j], 1, '111', ti[j], dt[j], to[j], i, j - i * 24))
+                self.definepattern(*patterns[j])
 
-        num = len(arr)
+        self.configurelut(num, rep)
 
-        encodedimages = []
-        sizes = []
+        last = len(sizes) - 1
+        for i in range(last + 1):
+            self.setbmp(last - i, sizes[last - i])
 
-        for i in range((num - 1) / 24 + 1):
-            print
-            'merging...'
-            if i < ((num - 1) / 24):
-                imagedata = mergeimages(arr[i * 24:(i + 1) * 24])
-            else:
-                imagedata = mergeimages(arr[i * 24:])
-            print
-            'encoding...'
-            imagedata, size = encode(imagedata)
+            print('uploading...')
+            self.bmpload(encodedimages[last - i], sizes[last - i], checkinterval)
 
-            encodedimages.append(imagedata)
-            sizes.append(size)
+        self.sequence = {'keys': keys, 'sizes': sizes, 'patterns': patterns, 'lut': (num, rep)}
 
-            if i < ((num - 1) / 24):
-                for j in range(i * 24, (i + 1) * 24):
-                    self.definepattern(j, exp[j], 1, '111', ti[j], dt[j], to[j], i, j - i * 24)
-            else:
-                for j in range(i * 24, num):
-                    self.definepattern(j, exp[j], 1, '111', ti[j], dt[j], to[j], i, j - i * 24)
+        if self.cache is not None:
+            print(self.cache.stats())
+
+    ## uploads a precompiled sequence (dmd_compile.SequenceFile): the pattern definitions, lut and
+    ## encoded frames are sent as stored, with nothing merged or encoded
+
+    def defprecompiled(self, sequence, checkinterval=1):
+
+        checksequence([p[1] for p in sequence.patterns], [p[4] for p in sequence.patterns],
+                      [p[5] for p in sequence.patterns], [p[2] for p in sequence.patterns])
+        self.stopsequence()
+        self.sequence = None
+
+        for pattern in sequence.patterns:
+            self.definepattern(*pattern)
+
+        num = len(sequence.patterns)
+        self.configurelut(num, sequence.repeat)
+
+        for i in range(len(sequence.frames) - 1, -1, -1):
+            self.setbmp(i, sequence.sizes[i])
+
+            print('uploading frame', i)
+            self.bmpstream([sequence.frames[i]], sequence.sizes[i], checkinterval)
+
+        self.sequence = {'keys': list(sequence.keys), 'sizes': list(sequence.sizes),
+                         'patterns': list(sequence.patterns), 'lut': (num, sequence.repeat)}
+
+    ## same as defsequence, but encoding and uploading overlap: a thread merges and encodes the frames and
+    ## passes them on in blocks through a queue of at most queuesize blocks while they are uploaded, so
+    ## usb transfers do not wait for the whole frame and only a few blocks per frame are held in memory.
+    ## The size for setbmp and the header comes from erle_size before the frame is encoded.
+
+    def streamsequence(self, images, exp, ti, dt, to, rep, checkinterval=1, queuesize=64):
+
+        checksequence(exp, ti, dt)
+        self.stopsequence()
+        self.sequence = None
+
+        num = len(exp)
+
+        groups = [packgroup(group) for group in patterngroups(images)]
+        checkcount(sum(len(group) for group in groups), num)
+        keys = [groupkey(group) for group in groups]
+
+        patterns = []
+        for i in range(len(groups)):
+            for j in range(i * 24, min((i + 1) * 24, num)):
+                patterns.append((j, exp[j], 1, '111', ti[j], dt[j], to[j], i, j - i * 24))
+                self.definepattern(*patterns[j])
 
         self.configurelut(num, rep)
 
-        for i in range((num - 1) / 24 + 1):
-            self.setbmp((num - 1) / 24 - i, sizes[(num - 1) / 24 - i])
+        blocks = queue.Queue(queuesize)
+        stop = threading.Event()
+        encoder = threading.Thread(target=streamframes, args=(groups, keys, blocks, stop, self.cache), daemon=True)
+        encoder.start()
 
-            print
-            'uploading...'
-            self.bmpload(encodedimages[(num - 1) / 24 - i], sizes[(num - 1) / 24 - i])
+        sizes = [None] * len(groups)
+        try:
+            for n in range(len(groups)):
+                item = blocks.get()
+                if isinstance(item, Exception):
+                    raise item
+                i, sizes[i] = item
+                self.setbmp(i, sizes[i])
+
+                print('uploading frame', i)
+                self.bmpstream(queueblocks(blocks), sizes[i], checkinterval)
+        finally:
+            stop.set()
+            encoder.join()
+
+        self.sequence = {'keys': keys, 'sizes': sizes, 'patterns': patterns, 'lut': (num, rep)}
 
+    ## changes the exposure, trigger in and dark time (one per pattern) of the sequence last uploaded,
+    ## redefining the patterns and lut without sending the frames again
+
+    def settiming(self, exp, ti, dt):
+        if self.sequence is None:
+            raise ValueError('no sequence has been uploaded')
+
+        checksequence(exp, ti, dt, [pattern[2] for pattern in self.sequence['patterns']])
+        self.stopsequence()
+        previous = self.sequence
+        self.sequence = None
+
+        patterns = []
+        for j, pattern in enumerate(previous['patterns']):
+            patterns.append(pattern[:1] + (exp[j],) + pattern[2:4] + (ti[j], dt[j]) + pattern[6:])
+            if patterns[j] != pattern:
+                self.definepattern(*patterns[j])
+
+        self.configurelut(*previous['lut'])
+        self.sequence = dict(previous, patterns=patterns)
+
+    ## same as defsequence, but only the frames, pattern definitions and lut that differ from the
+    ## sequence last uploaded are sent. Falls back to defsequence if nothing has been uploaded yet
+
+    def updatesequence(self, images, exp, ti, dt, to, rep, processes=None, checkinterval=1, verify=False):
+        if self.sequence is None:
+            return self.defsequence(images, exp, ti, dt, to, rep, processes, checkinterval, verify)
+
+        checksequence(exp, ti, dt)
+        self.stopsequence()
+        ## cleared while uploading, so a failed update is followed by a full defsequence
+        previous = self.sequence
+        self.sequence = None
+
+        num = len(exp)
+
+        try:
+            frames, keys = prepareframes(images, processes, self.cache, previous['keys'], verify, num)
+        except ValueError:
+            self.sequence = previous
+            raise
+        sizes = previous['sizes'][:len(frames)]
+        sizes += [None] * (len(frames) - len(sizes))
+
+        patterns = []
+        changed = 0
+        for i in range(len(frames)):
+            for j in range(i * 24, min((i + 1) * 24, num)):
+                patterns.append((j, exp[j], 1, '111', ti[j], dt[j], to[j], i, j - i * 24))
+                if j >= len(previous['patterns']) or previous['patterns'][j] != patterns[j]:
+                    self.definepattern(*patterns[j])
+                    changed += 1
+
+        if changed or previous['lut'] != (num, rep):
+            self.configurelut(num, rep)
+
+        last = len(frames) - 1
+        for i in range(last, -1, -1):
+            if frames[i] is not None:
+                encodedimage, sizes[i] = frames[i]
+                self.setbmp(i, sizes[i])
+
+                print('uploading frame', i)
+                self.bmpload(encodedimage, sizes[i], checkinterval)
+
+        print('updated', changed, 'of', num, 'patterns and',
+              len([frame for frame in frames if frame is not None]), 'of', len(frames), 'frames')
+        self.sequence = {'keys': keys, 'sizes': sizes, 'patterns': patterns, 'lut': (num, rep)}
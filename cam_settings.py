@@ -1,7 +1,6 @@
 import subprocess
 from shutil import copyfile
-import SiSoPyInterface as SISO
-from SiSoPyInterface import FG_XOFFSET, FG_YOFFSET, FG_HEIGHT, FG_WIDTH,FG_FRAMESPERSEC,FG_EXPOSURE
+from microscope.siso_backend import SISO
 import numpy as np
 import time
 import sys
@@ -161,10 +160,12 @@ class CameraSettings:
             parameter=self.cam_dict[command][1]
         else:
             parameter = self.cam_dict[command][1][paramnum]
-        param = globals()[parameter]
+        param = getattr(SISO, parameter)
         SISO.Fg_setParameterWithInt(self.fg, param, value, 0)
 
     def _upload_cam_commands(self):
+        if getattr(SISO, 'SIMULATED', False):
+            return SISO.simulate_cam_commands(self.fg, self.cam_cmds)
         p = subprocess.Popen([self.cam_shell_script], stdout=subprocess.PIPE)
         output = p.communicate()[0].split(b'\r\n')[1:-1]
         if b'>\x15' in output:
@@ -0,0 +1,179 @@
+import threading
+import numpy as np
+
+from microscope import siso_backend
+
+'''
+Framegrabber side of the camera with no Qt: FrameBuffer views the grab buffer and
+AcquisitionThread follows the frames as they arrive. camerahs.Camera builds both, siso_sim.main
+uses them on their own.
+
+Both take siso, the module with the SiSoPyInterface functions, which defaults to
+siso_backend.SISO.
+'''
+
+
+def backend(siso):
+    return siso_backend.SISO if siso is None else siso
+
+
+class FrameBuffer:
+    '''
+    Numpy view of the framegrabber memory allocated with Fg_AllocMemEx, so frames are read where
+    the framegrabber writes them with no copy or per frame SiSo call.
+
+    buffer = FrameBuffer(fg, memHandle, width, height, numpicsbuffer)
+
+    array is the whole buffer as one (numpics, height, width) uint8 array. Frames are indexed by
+    SiSo picture number, which starts at 1 and wraps around the buffer: picture n is held in
+    array[(n - 1) % numpics] until it is overwritten numpics pictures later.
+
+    buffer[n] is a view of picture n and buffer[start:stop] a view of pictures start to stop - 1,
+    copied only if the range wraps around the end of the buffer. chunks(start, stop) gives the
+    same range as one or two views, never copying.
+
+    If the framegrabber does not hand out the sub-buffers back to back, array is None, each
+    picture is viewed through its own pointer and ranges of pictures are copied.
+    '''
+
+    def __init__(self, fg, memHandle, width, height, numpics, siso=None):
+        self.siso = backend(siso)
+        self.fg = fg
+        self.memHandle = memHandle
+        self.width = width
+        self.height = height
+        self.numpics = numpics
+
+        self.views = [self.siso.getArrayFrom(self.siso.Fg_getImagePtrEx(fg, n, 0, memHandle), width, height)
+                      for n in range(1, min(numpics, 2) + 1)]
+        if numpics == 1 or self._address(self.views[1]) - self._address(self.views[0]) == width * height:
+            whole = self.siso.getArrayFrom(self.siso.Fg_getImagePtrEx(fg, 1, 0, memHandle), width, height * numpics)
+            self.array = np.asarray(whole).reshape(numpics, height, width)
+        else:
+            self.array = None
+            self.views = [self.siso.getArrayFrom(self.siso.Fg_getImagePtrEx(fg, n, 0, memHandle), width, height)
+                          for n in range(1, numpics + 1)]
+
+    @staticmethod
+    def _address(view):
+        return np.asarray(view).__array_interface__['data'][0]
+
+    def index(self, frame):
+        return (int(frame) - 1) % self.numpics
+
+    def last(self):
+        '''
+        Number of the last picture written by the framegrabber
+        '''
+        return self.siso.Fg_getLastPicNumberEx(self.fg, 0, self.memHandle)
+
+    def latest(self):
+        frame = self.last()
+        return frame, self[frame]
+
+    def __len__(self):
+        return self.numpics
+
+    def __getitem__(self, frame):
+        if isinstance(frame, slice):
+            start, stop, step = frame.start, frame.stop, frame.step
+            chunks = list(self.chunks(start, stop))
+            if len(chunks) == 1:
+                frames = chunks[0]
+            else:
+                frames = np.concatenate(chunks)
+            return frames[::step] if step is not None else frames
+        if self.array is None:
+            return self.views[self.index(frame)]
+        return self.array[self.index(frame)]
+
+    def chunks(self, start, stop):
+        '''
+        Generator of views covering pictures start to stop - 1, at most numpics pictures: one view,
+        or two when the range wraps around the end of the buffer
+        '''
+        if stop - start > self.numpics:
+            raise IndexError('Cannot view ' + str(stop - start) + ' frames of a ' + str(self.numpics) +
+                             ' frame buffer')
+        if stop <= start:
+            return
+        first = self.index(start)
+        last = self.index(stop - 1) + 1
+        if self.array is None:
+            if first < last:
+                yield np.stack(self.views[first:last])
+            else:
+                yield np.stack(self.views[first:])
+                yield np.stack(self.views[:last])
+        elif first < last:
+            yield self.array[first:last]
+        else:
+            yield self.array[first:]
+            yield self.array[:last]
+
+
+class AcquisitionThread(threading.Thread):
+    '''
+    Thread that waits on the framegrabber for each new frame with Fg_getLastPicNumberBlockingEx
+    and calls every subscriber with the number of the last frame, so nothing polls.
+
+    Subscribers are called in this thread and should return quickly. If they are slower than
+    the camera, frames are not queued: the next call gets the newest frame number.
+
+    finished is set when the last of numpics frames has arrived (never for GRAB_INFINITE), or
+    the acquisition is stopped or fails.
+    '''
+
+    def __init__(self, fg, memHandle, numpics, timeout=1, siso=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.siso = backend(siso)
+        self.fg = fg
+        self.memHandle = memHandle
+        self.numpics = numpics
+        self.timeout = timeout
+        self.subscribers = []
+        self.stopframe = None
+        self.last = 0
+        self.error = None
+        self.stopping = threading.Event()
+        self.finished = threading.Event()
+
+    def subscribe(self, function):
+        self.subscribers.append(function)
+
+    def unsubscribe(self, function):
+        self.subscribers.remove(function)
+
+    def stop_at(self, frame):
+        '''
+        Stops the acquisition from this thread as soon as picture frame has arrived
+        '''
+        self.stopframe = frame
+
+    def run(self):
+        try:
+            while not self.stopping.is_set():
+                last = self.siso.Fg_getLastPicNumberBlockingEx(self.fg, self.last + 1, 0, self.timeout, self.memHandle)
+                if last == self.siso.FG_TIMEOUT_ERR:
+                    continue
+                if last < 0:
+                    if not self.stopping.is_set():
+                        self.error = last
+                        print('Fg_getLastPicNumberBlockingEx() failed:', self.siso.Fg_getLastErrorDescription(self.fg))
+                    break
+
+                self.last = last
+                for function in list(self.subscribers):
+                    function(last)
+                if self.numpics != self.siso.GRAB_INFINITE and last >= self.numpics:
+                    break
+                if self.stopframe is not None and last >= self.stopframe:
+                    self.siso.Fg_stopAcquire(self.fg, 0)
+                    break
+        finally:
+            self.finished.set()
+
+    def stop(self):
+        self.stopping.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
@@ -8,11 +8,11 @@ from Generic.pyqt5_widgets import QtImageViewer
 from Generic.images import hstack
 from Generic.filedialogs import save_filename
 from microscope.video_cutter import VideoCutter
-import SiSoPyInterface as SISO
+from microscope.siso_backend import SISO
 
 from PyQt5.QtGui import QCloseEvent
 
-from microscope.camerahs import Camera
+from microscope.camerahs import Camera, LivePreview
 from microscope.camerasettings_gui import CameraSettingsGUI
 
 class QWidgetMod(QWidget):
@@ -34,7 +34,7 @@ class QWidgetMod(QWidget):
 class CameraControlGui(QWidgetMod):
     def __init__(self, parent=None):
         self.cam = Camera()
-        self.cam.initialise()
+        self.cam.initialise(display='qt')
 
         self.init_ui(parent)
 
@@ -49,8 +49,10 @@ class CameraControlGui(QWidgetMod):
         self.camset = CamSet(self.win, self.cam)
         self.saveas = SaveAs(self.win, self.cam)
         self.record = RecordControls(self.win, self.cam)
+        self.preview = LivePreview(self.win, self.cam)
 
 
+        self.vbox.addWidget(self.preview)
         self.vbox.addWidget(self.camset)
         self.vbox.addWidget(self.saveas)
         self.vbox.addWidget(self.record)
@@ -59,7 +61,7 @@ class CameraControlGui(QWidgetMod):
         self.win.setWindowTitle('VideoEditGui')
         self.screen_size = app.primaryScreen().size()
 
-        self.win.setGeometry(int(self.screen_size.width()*7/8), int(self.screen_size.height()*1/8), 200, 100)
+        self.win.setGeometry(int(self.screen_size.width() - 700), int(self.screen_size.height()*1/8), 680, 760)
 
         self.win.setLayout(self.vbox)
         self.win.show()
@@ -0,0 +1,196 @@
+import bisect
+import json
+import threading
+import time
+import numpy as np
+
+'''
+Instrumentation of the acquisition: when frames arrive, gaps in the frame numbers seen, how full
+the grab buffer is with frames not yet saved, and how long frames take to be displayed and saved.
+
+metrics = cam.metrics
+metrics.snapshot()                      # counters, rates, latency percentiles and histograms
+metrics.start_log('acquisition.jsonl')  # one snapshot per line every interval seconds
+
+Camera feeds it from its AcquisitionThread (frame_arrived), display_img and LivePreview
+(frame_displayed) and StreamRecorder (frames_saved, frames_dropped). Each call is a few
+arithmetic operations and one bisect into fixed histogram bins, cheap enough to leave on at
+several kHz.
+
+A gap is a wake up of the acquisition thread that found more than one new frame: frames that
+arrived while the subscribers were still busy, which were not lost but were seen late. Frames
+lost for good are the dropped frames, overwritten before StreamRecorder saved them.
+'''
+
+## latency and interval histogram bin edges (s), 10 us to 10 s, 10 bins per decade
+BINS = [10 ** (exponent / 10) for exponent in range(-50, 11)]
+
+
+class Histogram:
+    def __init__(self, edges=BINS):
+        self.edges = edges
+        self.counts = [0] * (len(edges) + 1)
+        self.total = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value, count=1):
+        self.counts[bisect.bisect_right(self.edges, value)] += count
+        self.total += count
+        self.sum += value * count
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        '''
+        Upper bin edge below which a fraction q of the values lie
+        '''
+        if self.total == 0:
+            return None
+        target = q * self.total
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return self.edges[i] if i < len(self.edges) else self.max
+        return self.max
+
+    def summary(self):
+        return {'count': self.total, 'mean': self.sum / self.total if self.total else None, 'max': self.max,
+                'p50': self.percentile(0.5), 'p90': self.percentile(0.9), 'p99': self.percentile(0.99)}
+
+
+class AcquisitionMetrics:
+    def __init__(self, numpicsbuffer):
+        self.numpicsbuffer = numpicsbuffer
+        self.log_thread = None
+        self.log_stop = threading.Event()
+        self.reset()
+
+    def reset(self):
+        self.start_time = time.perf_counter()
+        ## arrival time of each frame still in the buffer, by (frame - 1) % numpicsbuffer
+        self.arrivals = np.zeros(self.numpicsbuffer)
+        self.last = 0
+        self.last_time = None
+        self.wakeups = 0
+        self.gaps = 0
+        self.gap_frames = 0
+        self.largest_gap = 0
+        self.displayed = 0
+        self.saved = 0
+        self.dropped = 0
+        self.saved_next = None
+        self.fill = 0
+        self.max_fill = 0
+        self.interval = Histogram()
+        self.display_latency = Histogram()
+        self.save_latency = Histogram()
+
+    def frame_arrived(self, last):
+        '''
+        Called by the acquisition thread with the newest frame number
+        '''
+        now = time.perf_counter()
+        new = last - self.last
+        if new <= 0:
+            return
+        first = self.last % self.numpicsbuffer
+        if new >= self.numpicsbuffer:
+            self.arrivals[:] = now
+        elif first + new <= self.numpicsbuffer:
+            self.arrivals[first:first + new] = now
+        else:
+            self.arrivals[first:] = now
+            self.arrivals[:first + new - self.numpicsbuffer] = now
+
+        if self.last_time is not None:
+            self.interval.add((now - self.last_time) / new, new)
+        if new > 1:
+            self.gaps += 1
+            self.gap_frames += new - 1
+            self.largest_gap = max(self.largest_gap, new - 1)
+        self.wakeups += 1
+        self.last = last
+        self.last_time = now
+
+        if self.saved_next is not None:
+            self.fill = last - self.saved_next + 1
+            self.max_fill = max(self.max_fill, self.fill)
+
+    def arrival(self, frame):
+        if frame > self.last or self.last - frame >= self.numpicsbuffer:
+            return None
+        return float(self.arrivals[(frame - 1) % self.numpicsbuffer])
+
+    def frame_displayed(self, frame):
+        arrival = self.arrival(frame)
+        if arrival is not None:
+            self.display_latency.add(time.perf_counter() - arrival)
+        self.displayed += 1
+
+    def frames_saved(self, first, last):
+        '''
+        Called by the recorder once frames first to last are written
+        '''
+        arrival = self.arrival(last)
+        if arrival is not None:
+            self.save_latency.add(time.perf_counter() - arrival, last - first + 1)
+        self.saved += last - first + 1
+        self.saved_next = last + 1
+
+    def frames_dropped(self, first, last):
+        self.dropped += last - first + 1
+        self.saved_next = last + 1
+
+    def snapshot(self):
+        ## buffer fill is the fraction of numpicsbuffer grabbed but not yet saved, above 1 frames are lost
+        elapsed = time.perf_counter() - self.start_time
+        return {'time': time.time(),
+                'elapsed': elapsed,
+                'frames': self.last,
+                'fps': self.last / elapsed if elapsed > 0 else 0.0,
+                'wakeups': self.wakeups,
+                'gaps': self.gaps,
+                'gap_frames': self.gap_frames,
+                'largest_gap': self.largest_gap,
+                'displayed': self.displayed,
+                'saved': self.saved,
+                'dropped': self.dropped,
+                'buffer_fill': self.fill / self.numpicsbuffer,
+                'max_buffer_fill': self.max_fill / self.numpicsbuffer,
+                'interval': self.interval.summary(),
+                'display_latency': self.display_latency.summary(),
+                'save_latency': self.save_latency.summary()}
+
+    def histograms(self):
+        '''
+        Bin edges (s) and counts of the frame interval and latency histograms, the last count is
+        of values above the last edge
+        '''
+        return {'edges': BINS,
+                'interval': list(self.interval.counts),
+                'display_latency': list(self.display_latency.counts),
+                'save_latency': list(self.save_latency.counts)}
+
+    def start_log(self, filename, interval=1.0):
+        '''
+        Appends a snapshot to the json lines file filename every interval seconds until stop_log
+        '''
+        self.stop_log()
+        self.log_stop.clear()
+        self.log_thread = threading.Thread(target=self._log, args=(filename, interval), daemon=True)
+        self.log_thread.start()
+
+    def _log(self, filename, interval):
+        with open(filename, 'a') as fout:
+            while not self.log_stop.wait(interval):
+                fout.write(json.dumps(self.snapshot()) + '\n')
+                fout.flush()
+            fout.write(json.dumps(self.snapshot()) + '\n')
+
+    def stop_log(self):
+        if self.log_thread is not None:
+            self.log_stop.set()
+            self.log_thread.join()
+            self.log_thread = None
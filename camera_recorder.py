@@ -0,0 +1,137 @@
+import threading
+import numpy as np
+
+'''
+Recording that follows the grab, so the length of a run is limited by the disk rather than by
+numpicsbuffer.
+
+recorder = StreamRecorder(cam.buffer, WriteVideo(filename=..., frame_size=(height, width)))
+recorder.start()
+...
+recorder.stop()
+
+A thread follows the last picture number written by the framegrabber and writes each new frame
+to writer (anything with add_frame and close, e.g. Generic.video.WriteVideo, or add_frames for
+whole chunks at once as the raw_video writers have). Frames are copied
+out of the ring buffer in chunks, then the picture number is checked again, so a frame the
+framegrabber overwrote while it was being copied is never written.
+
+Frames overwritten before they were saved are buffer overruns. They are skipped, printed and
+kept as (first, last) picture number ranges in dropped, which is also saved in the metadata of
+writers that have it. Writers that number frames (frame_store.FrameStore) are told of each
+range through their skip method.
+'''
+
+
+class StreamRecorder(threading.Thread):
+    def __init__(self, buffer, writer, startframe=1, stopframe=None, chunk=64, poll=0.002, metrics=None,
+                 transform=None):
+        '''
+        buffer is a camera_buffer.FrameBuffer. Pictures startframe to stopframe (inclusive, None to record
+        until stop is called) are written to writer, at most chunk frames per copy, through transform
+        (a frame_transform.FrameTransform) if given. Saved and dropped frames are reported to metrics
+        (a camera_metrics.AcquisitionMetrics) if given
+        '''
+        threading.Thread.__init__(self, daemon=True)
+        self.buffer = buffer
+        self.writer = writer
+        self.stopframe = stopframe
+        self.chunk = max(min(chunk, buffer.numpics - 1), 1)
+        self.poll = poll
+        self.metrics = metrics
+        self.transform = transform
+        self.startframe = startframe
+        if metrics is not None:
+            metrics.saved_next = startframe
+
+        self.next = startframe
+        self.saved = 0
+        self.dropped = []
+        self.error = None
+        self.stopping = threading.Event()
+        self.ready = threading.Event()
+
+    def oldest(self, last):
+        '''
+        Oldest picture that is safe to read once picture last has been written, the framegrabber
+        may already be writing picture last + 1 over last + 1 - numpics
+        '''
+        return last + 2 - self.buffer.numpics
+
+    def _drop(self, first, last):
+        if self.metrics is not None:
+            self.metrics.frames_dropped(first, last)
+        if hasattr(self.writer, 'skip'):
+            self.writer.skip(first, last)
+        if self.dropped and self.dropped[-1][1] == first - 1:
+            first = self.dropped.pop()[0]
+        self.dropped.append((first, last))
+        print('buffer overrun: frames', first, 'to', last, 'were overwritten before they were saved')
+
+    def run(self):
+        try:
+            while self.stopframe is None or self.next <= self.stopframe:
+                last = self.buffer.last()
+                if last < self.next:
+                    if self.stopping.is_set():
+                        break
+                    self.ready.wait(self.poll)
+                    self.ready.clear()
+                    continue
+
+                if self.next < self.oldest(last):
+                    self._drop(self.next, self.oldest(last) - 1)
+                    self.next = self.oldest(last)
+
+                end = min(last, self.next + self.chunk - 1)
+                if self.stopframe is not None:
+                    end = min(end, self.stopframe)
+                frames = np.concatenate([np.array(view) for view in self.buffer.chunks(self.next, end + 1)])
+
+                ## frames overwritten while they were copied
+                oldest = self.oldest(self.buffer.last())
+                if self.next < oldest:
+                    self._drop(self.next, min(oldest - 1, end))
+                    frames = frames[oldest - self.next:]
+
+                saved = len(frames)
+                if self.transform is not None:
+                    frames = self.transform(frames, end - saved + 1 - self.startframe)
+                if hasattr(self.writer, 'add_frames'):
+                    self.writer.add_frames(frames)
+                else:
+                    for frame in frames:
+                        self.writer.add_frame(frame)
+                self.saved += saved
+                if self.metrics is not None and saved:
+                    self.metrics.frames_saved(end - saved + 1, end)
+                self.next = end + 1
+        except Exception as error:
+            self.error = error
+            print('recording failed:', error)
+        finally:
+            if hasattr(self.writer, 'metadata'):
+                self.writer.metadata['dropped'] = self.dropped
+            self.writer.close()
+
+    def notify(self, frame):
+        '''
+        Wakes the recorder, for camera_buffer.AcquisitionThread to call with each new frame
+        '''
+        self.ready.set()
+
+    @property
+    def overruns(self):
+        '''
+        Number of frames lost to buffer overruns
+        '''
+        return sum(last - first + 1 for first, last in self.dropped)
+
+    def stop(self, timeout=None):
+        '''
+        Writes the frames grabbed so far and stops recording
+        '''
+        self.stopping.set()
+        self.ready.set()
+        self.join(timeout)
+        print('recorded', self.saved, 'frames,', self.overruns, 'lost to buffer overruns')
@@ -1,4 +1,4 @@
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QTimer
 from PyQt5.QtGui import QPixmap
 from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QLabel, QApplication,
                              QSlider, QHBoxLayout, QPushButton)
@@ -7,7 +7,7 @@ import sys
 import os
 import cv2
 
-import SiSoPyInterface as SISO
+from microscope.siso_backend import SISO
 import numpy as np
 from Generic.filedialogs import save_filename
 from Generic.video import WriteVideo
@@ -15,8 +15,15 @@ from Generic.pyqt5_widgets import QtImageViewer
 from Generic.images import hstack
 from microscope.cam_settings import CameraSettings
 from microscope.camerasettings_gui import CameraSettingsGUI
+from microscope.camera_recorder import StreamRecorder
+from microscope.raw_video import raw_writer, RAW_EXTENSIONS
+from microscope.video_export import export_video
+from microscope.camera_metrics import AcquisitionMetrics
+from microscope.frame_store import FrameStore
+from microscope.frame_transform import FrameTransform
+from microscope.camera_buffer import FrameBuffer, AcquisitionThread
 import time
-from threading import Timer
+import threading
 from qimage2ndarray import array2qimage
 import matplotlib.pyplot as plt
 
@@ -30,14 +37,36 @@ class Camera:
         self.filename_base = filename.split('.')[0]
         print(self.filename_base)
         self.autosave=False
-
-    def initialise(self):
+        self.streaming=False
+        self.recorder=None
+        self.store=None
+        self.store_options=None
+        self.transform=None
+        self.acquisition=None
+        self.display_interval=0.02
+        self.last_draw=0
+        self.display=None
+        self.display_mode='siso'
+        self.trigger_frame=None
+        self.trigger_window=None
+
+    def initialise(self, display=None):
+        # display='qt' leaves out the SiSo display window, for use with LivePreview. The mode is kept, so
+        # initialising again after a change of settings (display=None) brings back the same display
+        if display is None:
+            display = self.display_mode
+        self.display_mode = display
         totalBufferSize = self.camset.cam_dict['frameformat'][2][2] * self.camset.cam_dict['frameformat'][2][3] * self.camset.cam_dict['numpicsbuffer'][2]
         self.memHandle = SISO.Fg_AllocMemEx(self.fg, totalBufferSize, self.camset.cam_dict['numpicsbuffer'][2])
-        self.display = SISO.CreateDisplay(8, self.camset.cam_dict['frameformat'][2][2],
-                                          self.camset.cam_dict['frameformat'][2][3])
-        SISO.SetBufferWidth(self.display, self.camset.cam_dict['frameformat'][2][2],
-                            self.camset.cam_dict['frameformat'][2][3])
+        self.buffer = FrameBuffer(self.fg, self.memHandle, self.camset.cam_dict['frameformat'][2][2],
+                                  self.camset.cam_dict['frameformat'][2][3], self.camset.cam_dict['numpicsbuffer'][2])
+        self.metrics = AcquisitionMetrics(self.camset.cam_dict['numpicsbuffer'][2])
+        self.display = None
+        if display == 'siso':
+            self.display = SISO.CreateDisplay(8, self.camset.cam_dict['frameformat'][2][2],
+                                              self.camset.cam_dict['frameformat'][2][3])
+            SISO.SetBufferWidth(self.display, self.camset.cam_dict['frameformat'][2][2],
+                                self.camset.cam_dict['frameformat'][2][3])
 
     def grab(self, numpics=0):
         if numpics == 0:
@@ -51,25 +80,57 @@ class Camera:
             print('Fg_AcquireEx() failed:', SISO.Fg_getLastErrorDescription(self.fg))
             self.resource_cleanup()
 
-        self.display_timer = DisplayTimer(0.03, self.display_img)
-        self.display_timer.start()
+        self.metrics.reset()
+        self.store = None
+        self.trigger_frame = None
+        self.trigger_window = None
+        if self.streaming:
+            self.start_recording(stopframe=None if self.numpics == SISO.GRAB_INFINITE else self.numpics)
+        elif self.store_options is not None:
+            self.start_store(stopframe=None if self.numpics == SISO.GRAB_INFINITE else self.numpics)
+
+        self.acquisition = AcquisitionThread(self.fg, self.memHandle, self.numpics)
+        self.acquisition.subscribe(self.metrics.frame_arrived)
+        if self.display is not None:
+            self.acquisition.subscribe(self.display_img)
+        if self.recorder is not None:
+            self.acquisition.subscribe(self.recorder.notify)
+        self.acquisition.start()
         if self.numpics != SISO.GRAB_INFINITE:
-            while self.display_timer.is_running:
-                time.sleep(0.1)
-            #self.stop()
-            if self.autosave:
+            self.acquisition.join()
+            if self.recorder is not None:
+                self.stop_recording()
+            if self.autosave and not self.streaming:
                 print(self.numpics)
                 self.save_vid(startframe=1, stopframe=self.numpics)
                 self.resource_cleanup()
 
     def trigger(self):
+        # Stops exactly picsaftertrigger frames after the frame grabbed at the trigger. trigger_window is then
+        # the (startframe, stopframe) range for save_vid of every frame up to there still in the buffer
         picsaftertrigger = self.camset.cam_dict['picsaftertrigger'][2]
-        framerate = self.camset.cam_dict['framerate'][2]
-        if picsaftertrigger != 0:
-            time.sleep(picsaftertrigger/framerate)
-        self.display_timer.stop()
+        self.trigger_frame = self.buffer.last()
+        stopframe = self.trigger_frame + picsaftertrigger
+        if self.acquisition is not None and picsaftertrigger != 0:
+            self.acquisition.stop_at(stopframe)
+            self.acquisition.finished.wait()
         self.stop()
 
+        last = self.buffer.last()
+        first = max(1, last - self.buffer.numpics + 1)
+        if self.store is not None and len(self.store):
+            first = min(first, self.store.first())
+        self.trigger_window = (first, min(stopframe, last) + 1)
+        print('Triggered at frame', self.trigger_frame, 'keeping frames', self.trigger_window[0], 'to',
+              self.trigger_window[1] - 1)
+
+    def save_trigger(self, ext='.mp4', filename=None, parallel=False):
+        # Saves the frames around the last trigger
+        if self.trigger_window is None:
+            print('No trigger recorded')
+            return
+        self.save_vid(self.trigger_window[0], self.trigger_window[1], ext=ext, filename=filename, parallel=parallel)
+
     def snap(self, filename=None, ext='.png'):
         if filename is not None:
             self.filename_base =filename.split('.')[0]
@@ -77,10 +138,7 @@ class Camera:
         img_filename = self.filename_base.split('Videos/')[0] + 'Pictures/' + self.filename_base.split('Videos/')[1]
         print(img_filename)
         date_time = self.datetimestr()
-        cur_pic_nr = SISO.Fg_getLastPicNumberEx(self.fg, 0, self.memHandle)
-        img_ptr = SISO.Fg_getImagePtrEx(self.fg, cur_pic_nr, 0, self.memHandle)
-        nImg = SISO.getArrayFrom(img_ptr, self.camset.cam_dict['frameformat'][2][2],
-                                 self.camset.cam_dict['frameformat'][2][3])
+        cur_pic_nr, nImg = self.buffer.latest()
         cv2.imwrite(img_filename+date_time+ext, nImg)
 
     def snap_max_array(self):
@@ -91,35 +149,47 @@ class Camera:
         return nImg
 
     def get_pixmap_image(self, frame):
-        img_ptr = SISO.Fg_getImagePtrEx(self.fg, int(frame), 0, self.memHandle)
-        nImg = SISO.getArrayFrom(img_ptr, self.camset.cam_dict['frameformat'][2][2],
-                                 self.camset.cam_dict['frameformat'][2][3])
+        frame = int(frame)
+        if self.lost(frame, frame + 1):
+            # lost to a buffer overrun, shown black
+            nImg = np.zeros((self.buffer.height, self.buffer.width), dtype='uint8')
+        else:
+            nImg = self.frame_source(frame, frame + 1)[frame]
         pixmap = QPixmap.fromImage(array2qimage(nImg))
         return pixmap
 
 
 
-    def display_img(self):
-        cur_pic_nr = SISO.Fg_getLastPicNumberEx(self.fg, 0, self.memHandle)
-        if cur_pic_nr == self.numpics:
-            self.display_timer.stop()
-            if self.autosave:
-                self.save_vid(self.filename_base, 1, self.numpics)
-                self.resource_cleanup()
-        else:
-            win_name_img = "Source Image (SiSo Runtime)"
-            # get image pointer
-            img_ptr = SISO.Fg_getImagePtrEx(self.fg, cur_pic_nr, 0, self.memHandle)
-            SISO.DrawBuffer(self.display, img_ptr, cur_pic_nr, win_name_img)
+    def display_img(self, cur_pic_nr):
+        # Called by the acquisition thread for each new frame, drawn at most every display_interval s
+        now = time.perf_counter()
+        if now - self.last_draw < self.display_interval and cur_pic_nr != self.numpics:
+            return
+        self.last_draw = now
+        win_name_img = "Source Image (SiSo Runtime)"
+        # get image pointer
+        img_ptr = SISO.Fg_getImagePtrEx(self.fg, cur_pic_nr, 0, self.memHandle)
+        SISO.DrawBuffer(self.display, img_ptr, cur_pic_nr, win_name_img)
+        self.metrics.frame_displayed(cur_pic_nr)
 
     def stop(self):
+        # The acquisition thread is told first, so the wait Fg_stopAcquire cuts short is not taken for a failure
+        if self.acquisition is not None:
+            self.acquisition.stopping.set()
         SISO.Fg_stopAcquire(self.fg, 0)
+        if self.acquisition is not None:
+            self.acquisition.stop()
+        if self.recorder is not None:
+            self.stop_recording()
 
     def datetimestr(self):
         now = time.gmtime()
         return time.strftime("%Y%m%d_%H%M%S", now)
 
-    def save_vid(self, startframe=1, stopframe=100, ext='.mp4', filename=None):
+    def save_vid(self, startframe=1, stopframe=100, ext='.mp4', filename=None, parallel=False, processes=None,
+                 transform=None):
+        # parallel encodes chunks of frames in a process pool from a shared memory copy, see video_export.
+        # transform (a FrameTransform, self.transform if None) crops, bins and skips frames before they are written
         if startframe == 0:
             print('Frame numbers start from 1 setting startframe to 1')
             startframe = 1
@@ -128,18 +198,144 @@ class Camera:
             filename_op = self.filename_base+str(date_time)+ext
         else:
             filename_op=filename + ext
-        writevid = WriteVideo(filename=filename_op, frame_size=(
-                                self.camset.cam_dict['frameformat'][2][3], self.camset.cam_dict['frameformat'][2][2]))
-
-        for frame in range(startframe, stopframe, 1):
-            img_ptr = SISO.Fg_getImagePtrEx(self.fg, int(frame), 0, self.memHandle)
-            nImg = SISO.getArrayFrom(img_ptr, self.camset.cam_dict['frameformat'][2][2],
-                                 self.camset.cam_dict['frameformat'][2][3])
-
-            writevid.add_frame(nImg)
-        writevid.close()
+        if transform is None:
+            transform = self.transform
+        lost = self.lost(startframe, stopframe)
+        if lost:
+            # Frames lost to buffer overruns are missing from the store, each part either side is saved on its own
+            print('Frames', ', '.join(str(first) + ' to ' + str(last) for first, last in lost),
+                  'were lost, saving the frames either side separately')
+            base = filename_op[:len(filename_op) - len(ext)]
+            for start, stop in self.store.segments(startframe, stopframe):
+                self.save_vid(start, stop, ext=ext, filename=base + '_frames_' + str(start) + '_' + str(stop - 1),
+                              parallel=parallel, processes=processes, transform=transform)
+            return
+        chunks = self.frame_source(startframe, stopframe).chunks(startframe, stopframe)
+        if transform is not None:
+            chunks = self.transform_chunks(chunks, transform)
+        if parallel and ext not in RAW_EXTENSIONS:
+            frame_size = (self.buffer.height, self.buffer.width)
+            numframes = stopframe - startframe
+            if transform is not None:
+                if transform.dtype != 'uint8':
+                    raise ValueError('Compressed video needs uint8 frames, save ' + str(transform.dtype) +
+                                     ' as .npy or .h5')
+                frame_size = transform.frame_size(frame_size)
+                numframes = transform.count(numframes)
+            export_video(chunks, numframes, frame_size, filename_op, processes)
+            print('Finished writing video')
+            return
+
+        writevid = self.video_writer(filename_op, transform)
+
+        try:
+            for frames in chunks:
+                if ext in RAW_EXTENSIONS:
+                    writevid.add_frames(frames)
+                else:
+                    for nImg in frames:
+                        writevid.add_frame(nImg)
+        finally:
+            writevid.close()
         print('Finished writing video')
 
+    def start_recording(self, startframe=1, stopframe=None, ext='.mp4', filename=None):
+        # Writes frames to disk while they are grabbed, see camera_recorder.StreamRecorder
+        if filename is None:
+            filename_op = self.filename_base + self.datetimestr() + ext
+        else:
+            filename_op = filename + ext
+        writevid = self.video_writer(filename_op, self.transform)
+        self.recorder = StreamRecorder(self.buffer, writevid, startframe=startframe, stopframe=stopframe,
+                                       metrics=self.metrics, transform=self.transform)
+        self.recorder.start()
+
+    def start_store(self, startframe=1, stopframe=None):
+        # Drains the grab buffer into a compressed in-RAM FrameStore, see frame_store
+        self.store = FrameStore((self.buffer.height, self.buffer.width), startframe=startframe,
+                                settings=self.camset.cam_dict, **self.store_options)
+        self.recorder = StreamRecorder(self.buffer, self.store, startframe=startframe, stopframe=stopframe,
+                                       metrics=self.metrics)
+        self.recorder.start()
+
+    def frame_source(self, startframe, stopframe):
+        # The store if it holds every frame startframe to stopframe - 1, otherwise the grab buffer
+        if self.store is not None and len(self.store) and not self.store.missing(startframe, stopframe):
+            return self.store
+        return self.buffer
+
+    def lost(self, startframe, stopframe):
+        # (first, last) ranges of frames startframe to stopframe - 1 lost to buffer overruns while the store
+        # was recording, they are in neither the store nor the grab buffer
+        if self.store is None or not len(self.store) or startframe < self.store.first() \
+                or stopframe - 1 > self.store.last():
+            return []
+        return self.store.missing(startframe, stopframe)
+
+    def holds(self, startframe, stopframe):
+        # Whether frames startframe to stopframe - 1 can still be read from the store or the grab buffer
+        if self.frame_source(startframe, stopframe) is self.store:
+            return True
+        if self.lost(startframe, stopframe):
+            return False
+        last = self.buffer.last()
+        return max(1, last - self.buffer.numpics + 1) <= startframe and stopframe - 1 <= last
+
+    def frame_range(self):
+        # First and last frame that can be viewed or saved
+        if self.store is not None and len(self.store):
+            return self.store.first(), self.store.last()
+        return 1, self.camset.cam_dict['numpicsbuffer'][2]
+
+    def video_writer(self, filename, transform=None):
+        # Lossless .npy / .h5 stacks with the camera settings, anything else is compressed video
+        frame_size = (self.buffer.height, self.buffer.width)
+        dtype = 'uint8'
+        if transform is not None:
+            frame_size = transform.frame_size(frame_size)
+            dtype = transform.dtype
+        if filename.endswith(RAW_EXTENSIONS):
+            writevid = raw_writer(filename, frame_size, settings=self.camset.cam_dict, dtype=dtype)
+            if transform is not None:
+                writevid.metadata['transform'] = transform.settings()
+            return writevid
+        if dtype != 'uint8':
+            raise ValueError('Compressed video needs uint8 frames, save ' + str(dtype) + ' as .npy or .h5')
+        return WriteVideo(filename=filename, frame_size=frame_size)
+
+    @staticmethod
+    def transform_chunks(chunks, transform):
+        # Applies transform to blocks of frames, numbering the frames on from the first block
+        offset = 0
+        for frames in chunks:
+            yield transform(frames, offset)
+            offset += len(frames)
+
+    def stop_recording(self):
+        recorder = self.recorder
+        self.recorder = None
+        recorder.stop()
+        return recorder.dropped
+
+    def set_streaming(self, streaming=False, filename=None):
+        # Record every grab straight to disk instead of saving the buffer afterwards
+        self.streaming = streaming
+        if filename is not None:
+            self.filename_base = filename.split('.')[0]
+
+    def set_compressed(self, compressed=False, **options):
+        # Keep every grab in a compressed in-RAM store as well as the grab buffer, so more frames can be
+        # saved afterwards. options are passed to FrameStore, e.g. codec='lz4', delta=True, max_bytes=8e9. Without
+        # max_bytes the store keeps half the RAM's worth of the newest frames, however long the grab runs
+        self.store_options = options if compressed else None
+
+    def set_transform(self, crop=None, bin=1, stride=1, dtype='uint8'):
+        # Save only the crop (x, y, width, height), binned bin x bin and every stride'th frame, see frame_transform
+        if crop is None and bin == 1 and stride == 1 and dtype == 'uint8':
+            self.transform = None
+        else:
+            self.transform = FrameTransform(crop=crop, bin=bin, stride=stride, dtype=dtype)
+
     def set_autosave(self, autosave=False, filename=None):
         self.autosave = autosave
         if self.autosave:
@@ -147,11 +343,14 @@ class Camera:
                 self.filename_base = filename.split('.')[0]
 
     def resource_cleanup(self):
-        SISO.CloseDisplay(self.display)
+        if self.display is not None:
+            SISO.CloseDisplay(self.display)
         print('Resources released')
 
 
     def close_display(self):
+        if self.display is None:
+            return
         SISO.CloseDisplay(self.display)
         os.system('wmctrl -a "Display"')
         os.system('wmctrl -c "Display"')
@@ -159,37 +358,73 @@ class Camera:
 
     def reset_display(self):
         self.stop()
-        self.display_timer.stop()
         self.close_display()
         time.sleep(0.1)
 
 
-class DisplayTimer(object):
-    def __init__(self, interval, startfunction):
-        self._timer     = None
-        self.interval   = interval
-        self.startfunction   = startfunction
-        #self.stopfunction = stopfunction
-        self.is_running = False
-        self.start()
-
-    def _run(self):
-        self.is_running = False
-        self.start()
-
-
-    def start(self):
-        self.startfunction()
-        if not self.is_running:
-            self._timer = Timer(self.interval, self._run)
-            self._timer.start()
-            self.is_running = True
+def reduce_frame(frame, factor, mode='bin'):
+    '''
+    Shrinks frame by an integer factor, either binning (the mean of each factor x factor block,
+    trimming the edges that do not fill a block) or decimating (every factor'th pixel)
+    '''
+    if factor <= 1:
+        return frame
+    if mode == 'decimate':
+        return frame[::factor, ::factor]
+    height = frame.shape[0] // factor
+    width = frame.shape[1] // factor
+    blocks = frame[:height * factor, :width * factor].reshape(height, factor, width, factor)
+    return (blocks.sum(axis=(1, 3), dtype='uint32') // (factor * factor)).astype(frame.dtype)
+
+
+class LivePreview(QWidget):
+    '''
+    Qt live view of the camera, replacing the SiSo display window.
+
+    A QTimer shows the newest frame at rate Hz, however fast the camera grabs: frames that
+    arrived in between are never drawn and a tick with no new frame draws nothing. Frames larger
+    than max_size (rows, columns) are binned or decimated (mode 'bin' or 'decimate') by the
+    smallest integer factor that fits, so a preview costs the same at any frame rate and ROI.
+    '''
+
+    def __init__(self, parent, cam, rate=25, max_size=(512, 640), mode='bin'):
+        QWidget.__init__(self, parent)
+        self.cam = cam
+        self.max_size = max_size
+        self.mode = mode
+        self.shown = 0
+        self.drawn = 0
+
+        self.setLayout(QVBoxLayout())
+        self.viewer = QtImageViewer()
+        self.layout().addWidget(self.viewer)
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.update_preview)
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        self.timer.start(int(1000 / rate))
+
+    def factor(self, frame):
+        return max(-(-frame.shape[0] // self.max_size[0]), -(-frame.shape[1] // self.max_size[1]), 1)
+
+    def update_preview(self):
+        if self.cam.acquisition is not None:
+            frame_num = self.cam.acquisition.last
+        else:
+            frame_num = self.cam.buffer.last()
+        if frame_num <= 0 or frame_num == self.shown:
+            return
+        frame = self.cam.buffer[frame_num]
+        preview = reduce_frame(frame, self.factor(frame), self.mode)
+        self.viewer.setImage(QPixmap.fromImage(array2qimage(preview)))
+        self.cam.metrics.frame_displayed(frame_num)
+        self.shown = frame_num
+        self.drawn += 1
 
     def stop(self):
-        self._timer.cancel()
-        self.is_running = False
-
-
+        self.timer.stop()
 
 
 if __name__ == '__main__':
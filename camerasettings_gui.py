@@ -1,7 +1,7 @@
 
 import numpy as np
 import sys
-import SiSoPyInterface as SISO
+from microscope.siso_backend import SISO
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QPixmap
 from microscope.ROIfigure import ROIGraphDialog
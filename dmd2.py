@@ -1,12 +1,19 @@
-from PyQt5.QtCore import Qt, pyqtSlot
+from PyQt5.QtCore import Qt, pyqtSlot, pyqtSignal, QObject
 from PyQt5.QtGui import QPixmap, QImage, QPainterPath, QCloseEvent
 from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QLabel, QApplication,
-                             QSlider, QHBoxLayout, QPushButton, QCheckBox, QLineEdit)
+                             QSlider, QHBoxLayout, QPushButton, QCheckBox, QLineEdit, QProgressBar)
 from Generic.pyqt5_widgets import CheckedSlider
 from Generic.filedialogs import open_directory
+from microscope.dmd_controller import DMDController
 
 import sys
 
+class ControllerSignals(QObject):
+    # Carries the controller callbacks from its threads to the Qt thread
+    progress = pyqtSignal(int, int)
+    status = pyqtSignal(str)
+
+
 class DMDGui:
     def __init__(self):
         self.init_ui()
@@ -17,35 +24,72 @@ class DMDGui:
         self.win = QWidget()
         self.vbox = QVBoxLayout(self.win)
 
-        led_chooser = LEDselector(self.win)
-        display_chooser = DisplaySelector(self.win)
-        rate_chooser = PatternRateSelector(self.win)
-        file_chooser = FileSelector(self.win)
-
-        self.vbox.addWidget(led_chooser)
-        self.vbox.addWidget(display_chooser)
-        self.vbox.addWidget(rate_chooser)
-        self.vbox.addWidget(file_chooser)
+        # All dmd commands go through the controller so the gui never waits on usb
+        self.signals = ControllerSignals()
+        self.controller = DMDController(progress=self.signals.progress.emit, status=self.signals.status.emit)
+        self.controller.connect()
 
+        self.led_chooser = LEDselector(self.win, self.led_chooser_callback)
+        self.display_chooser = DisplaySelector(self.win, self.display_chooser_callback)
+        self.rate_chooser = PatternRateSelector(self.win, function=self.rate_chooser_callback)
+        self.file_chooser = FileSelector(self.win)
 
+        self.vbox.addWidget(self.led_chooser)
+        self.vbox.addWidget(self.display_chooser)
+        self.vbox.addWidget(self.rate_chooser)
+        self.vbox.addWidget(self.file_chooser)
+        self.upload_button()
 
         # Finalise window
         self.win.setWindowTitle('DMD Control Gui')
         self.win.setLayout(self.vbox)
         self.win.show()
-        sys.exit(app.exec_())
+        ret = app.exec_()
+        self.controller.close()
+        sys.exit(ret)
 
     def upload_button(self):
-        self.upload_filename_lblB = QLabel()
-        self.upload_filename_lblB.setText(self.filename)
+        widget = QWidget()
+        hbox = QHBoxLayout()
         self.upload_images = QPushButton("Upload Images")
         self.upload_images.clicked.connect(self.upload_callback)
+        self.cancel_upload = QPushButton("Cancel")
+        self.cancel_upload.clicked.connect(self.cancel_callback)
+        self.upload_progress = QProgressBar()
+        self.upload_status = QLabel()
+        self.signals.progress.connect(self.progress_callback)
+        self.signals.status.connect(self.upload_status.setText)
+
+        hbox.addWidget(self.upload_images)
+        hbox.addWidget(self.cancel_upload)
+        hbox.addWidget(self.upload_progress)
+        hbox.addWidget(self.upload_status)
+        widget.setLayout(hbox)
+        self.vbox.addWidget(widget)
 
     def upload_callback(self):
-        pass
+        self.controller.upload(self.file_chooser.directory)
+
+    def cancel_callback(self):
+        self.controller.cancel()
+
+    def progress_callback(self, sent, size):
+        self.upload_progress.setMaximum(size)
+        self.upload_progress.setValue(sent)
+
+    def led_chooser_callback(self, red, green, blue):
+        self.controller.setleds(red, green, blue)
+
+    def rate_chooser_callback(self, rate, exposure, triggered):
+        self.controller.settiming(rate, exposure, triggered)
 
     def display_chooser_callback(self, display_off, display_on, display_cycle):
-        print(display_off, display_on, display_cycle)
+        if display_cycle:
+            self.controller.display('cycle')
+        elif display_on:
+            self.controller.display('on')
+        else:
+            self.controller.display('off')
 
 
 
@@ -72,10 +116,11 @@ class DMDGui:
 
 class LEDselector(QWidget):
 
-    def __init__(self, parent):
+    def __init__(self, parent, function=None):
         self.redval = 0
         self.greenval = 0
         self.blueval = 0
+        self.function = function
 
         QWidget.__init__(self, parent)
         self.setLayout(QVBoxLayout())
@@ -94,6 +139,7 @@ class LEDselector(QWidget):
             self.redval = redval
         else:
             self.red_led.slider.setEnabled(False)
+        self.call_function()
 
     def green_led_val(self, greenval):
         if self.green_led.check:
@@ -101,6 +147,7 @@ class LEDselector(QWidget):
             self.greenval = greenval
         else:
             self.green_led.slider.setEnabled(False)
+        self.call_function()
 
     def blue_led_val(self, blueval):
         if self.blue_led.check:
@@ -108,16 +155,25 @@ class LEDselector(QWidget):
             self.blueval = blueval
         else:
             self.blue_led.slider.setEnabled(False)
+        self.call_function()
+
+    def call_function(self):
+        # Unchecked leds are sent as None, switching them off
+        if self.function is not None:
+            self.function(self.redval if self.red_led.check else None,
+                          self.greenval if self.green_led.check else None,
+                          self.blueval if self.blue_led.check else None)
 
 
 
 
 class DisplaySelector(QWidget):
 
-    def __init__(self, parent):
+    def __init__(self, parent, function=None):
         self.off = True
         self.on = False
         self.cycle = False
+        self.function = function
 
         QWidget.__init__(self, parent)
         self.setLayout(QHBoxLayout())
@@ -162,11 +218,13 @@ class DisplaySelector(QWidget):
         self.display_off.setChecked(self.off)
         self.display_on.setChecked(self.on)
         self.display_cycle.setChecked(self.cycle)
-        #self.function(self.off, self.on, self.cycle)
+        if self.function is not None:
+            self.function(self.off, self.on, self.cycle)
 
 class PatternRateSelector(QWidget):
-    def __init__(self, parent, rate=100, exposure=10, triggered=False):
+    def __init__(self, parent, rate=100, exposure=1000, triggered=False, function=None):
         QWidget.__init__(self, parent)
+        self.function = function
         self.rate_val=str(rate)
         self.exposure_val=str(exposure)
         self.triggered_val=triggered
@@ -203,13 +261,15 @@ class PatternRateSelector(QWidget):
         layout_triggered.addWidget(self.triggered)
 
         self.setLayout(hbox)
+        self.call_function()
 
     def rate_callback(self):
-        value = self.rate.text()
-
+        self.rate_val = self.rate.text()
+        self.call_function()
 
     def exposure_callback(self):
-        value = self.exposure.text()
+        self.exposure_val = self.exposure.text()
+        self.call_function()
 
 
     def triggered_callback(self, state):
@@ -219,6 +279,16 @@ class PatternRateSelector(QWidget):
             self.rate.setEnabled(False)
         else:
             self.rate.setEnabled(True)
+        self.call_function()
+
+    def call_function(self):
+        try:
+            rate = float(self.rate_val)
+            exposure = int(self.exposure_val)
+        except ValueError:
+            return
+        if self.function is not None:
+            self.function(rate, exposure, self.triggered_val)
 
         
 
@@ -0,0 +1,184 @@
+import argparse
+import json
+import platform
+import time
+import numpy as np
+
+from microscope.PyCrafter import convlen, bitstobytes, mergeimages, encode, erle_encode, dmd
+from microscope.fake_dmd import FakeDMD
+
+'''
+Benchmarks of the DMD preparation path: convlen/bitstobytes, mergeimages, erle_encode, command
+packetisation and bmpload against fake_dmd.FakeDMD, on synthetic pattern sets.
+
+python -m microscope.dmd_benchmark --output bench.json --baseline last_bench.json
+
+Each stage reports the best time over repeats, bytes produced and, for encoding, the compression
+ratio against the raw 1920x1080x24 bit frame. Results are written as JSON; with --baseline each
+stage is compared with an earlier results file and slowdowns beyond --tolerance are flagged.
+'''
+
+SHAPE = (1080, 1920)
+RAW_FRAME_BYTES = SHAPE[0] * SHAPE[1] * 3
+PATTERN_SETS = ('blank', 'gratings', 'speckle', 'spots')
+
+
+def synthetic_patterns(kind, num=24, seed=0):
+    '''
+    Returns num binary (1080, 1920) uint8 patterns of the given kind:
+    blank - all off, gratings - vertical gratings of increasing period,
+    speckle - random pixels, half on, spots - sparse grid of small discs
+    '''
+    y, x = np.ogrid[:SHAPE[0], :SHAPE[1]]
+    rng = np.random.default_rng(seed)
+    patterns = []
+    for i in range(num):
+        if kind == 'blank':
+            pattern = np.zeros(SHAPE, dtype='uint8')
+        elif kind == 'gratings':
+            pattern = np.broadcast_to((x // (4 + 2 * i)) % 2, SHAPE).astype('uint8')
+        elif kind == 'speckle':
+            pattern = rng.integers(0, 2, SHAPE, dtype='uint8')
+        elif kind == 'spots':
+            pitch = 64
+            offset = rng.integers(0, pitch, 2)
+            pattern = ((((x + offset[0]) % pitch) - pitch // 2) ** 2 +
+                       (((y + offset[1]) % pitch) - pitch // 2) ** 2 < 16).astype('uint8')
+        else:
+            raise ValueError('Unknown pattern set ' + kind)
+        patterns.append(pattern)
+
+    return patterns
+
+
+def _best(function, repeats):
+    times = []
+    result = None
+    for repeat in range(repeats):
+        t = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - t)
+
+    return min(times), result
+
+
+def bench_bits(repeats=5, num=10000):
+    values = np.random.default_rng(0).integers(0, 2 ** 24, num)
+
+    def run():
+        for value in values:
+            bitstobytes(convlen(int(value), 24))
+    seconds, result = _best(run, repeats)
+
+    return {'seconds': seconds, 'calls': num, 'us_per_call': seconds / num * 1e6, 'bytes': 3 * num}
+
+
+def bench_merge(patterns, repeats=3):
+    seconds, merged = _best(lambda: mergeimages(patterns), repeats)
+
+    return {'seconds': seconds, 'bytes': merged.nbytes}, merged
+
+
+def bench_encode(merged, repeats=3, reference=False):
+    seconds, (encoded, size) = _best(lambda: erle_encode(merged), repeats)
+    result = {'seconds': seconds, 'bytes': size, 'compression': RAW_FRAME_BYTES / size}
+    if reference:
+        t = time.perf_counter()
+        try:
+            encode(merged)
+            result['reference_seconds'] = time.perf_counter() - t
+        except IndexError:
+            result['reference_seconds'] = None
+
+    return result, encoded
+
+
+def bench_command(repeats=5, num=2000):
+    device = FakeDMD(keepwrites=False)
+    controller = dmd(dev=device)
+
+    def run():
+        for i in range(num):
+            controller.definepattern(i % 400, 1000, 1, '111', False, 0, 1, i // 24 % 17, i % 24)
+    seconds, result = _best(run, repeats)
+
+    return {'seconds': seconds, 'calls': num, 'us_per_call': seconds / num * 1e6,
+            'bytes': device.byteswritten // repeats}
+
+
+def bench_upload(encoded, repeats=3, checkinterval=1, latency=0.0):
+    device = FakeDMD(keepwrites=False, latency=latency)
+    controller = dmd(dev=device)
+    seconds, result = _best(lambda: controller.bmpload(encoded, len(encoded), checkinterval), repeats)
+
+    return {'seconds': seconds, 'bytes': len(encoded), 'MBps': len(encoded) / seconds / 1e6,
+            'reports': device.byteswritten // 64 // repeats, 'checkinterval': checkinterval}
+
+
+def run_benchmarks(sets=PATTERN_SETS, repeats=3, reference=False, latency=0.0):
+    results = {'time': time.strftime('%Y%m%d_%H%M%S', time.gmtime()), 'python': platform.python_version(),
+               'numpy': np.__version__, 'machine': platform.node(), 'stages': {}}
+    stages = results['stages']
+    stages['convlen_bitstobytes'] = bench_bits(repeats)
+    stages['command'] = bench_command(repeats)
+
+    for kind in sets:
+        patterns = synthetic_patterns(kind)
+        stages[kind + '/mergeimages'], merged = bench_merge(patterns, repeats)
+        stages[kind + '/encode'], encoded = bench_encode(merged, repeats, reference)
+        stages[kind + '/bmpload'] = bench_upload(encoded, repeats, 1, latency)
+        stages[kind + '/bmpload_interval64'] = bench_upload(encoded, repeats, 64, latency)
+
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    '''
+    Returns the stages whose time grew by more than tolerance (a fraction) since baseline
+    '''
+    slower = {}
+    for stage, result in results['stages'].items():
+        if stage in baseline['stages']:
+            before = baseline['stages'][stage]['seconds']
+            if before > 0 and result['seconds'] > before * (1 + tolerance):
+                slower[stage] = result['seconds'] / before
+
+    return slower
+
+
+def print_results(results):
+    for stage, result in results['stages'].items():
+        line = stage.ljust(32) + str(round(result['seconds'] * 1000, 3)).rjust(12) + ' ms'
+        line += str(result['bytes']).rjust(12) + ' bytes'
+        if 'compression' in result:
+            line += '  compression ' + str(round(result['compression'], 1))
+        if 'MBps' in result:
+            line += '  ' + str(round(result['MBps'], 2)) + ' MB/s'
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the DMD encode, merge and upload path')
+    parser.add_argument('--output', default='dmd_benchmark.json', help='json file to write the results to')
+    parser.add_argument('--baseline', help='earlier results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against the baseline')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--sets', nargs='+', default=list(PATTERN_SETS), choices=PATTERN_SETS)
+    parser.add_argument('--reference', action='store_true', help='also time the original encode (slow)')
+    parser.add_argument('--latency', type=float, default=0.0, help='fake usb read latency (s)')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sets, args.repeats, args.reference, args.latency)
+    print_results(results)
+    with open(args.output, 'w') as fout:
+        json.dump(results, fout, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as fin:
+            slower = compare(results, json.load(fin), args.tolerance)
+        for stage, ratio in slower.items():
+            print('REGRESSION', stage, str(round(ratio, 2)) + 'x slower')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+import os
+from collections import OrderedDict
+
+
+class ERLECache:
+    '''
+    On disk cache of encoded DMD frames, so that pattern groups which have been uploaded before
+    skip mergeimages and erle_encode.
+
+    Each frame is stored as a file <key>.erle holding the enhanced rle bytes exactly as they
+    are sent to the DMD; the frame size is the file size. Keys come from PyCrafter.groupkey,
+    a hash of the bit-planes making up the 24 bit frame.
+
+    The cache is capped at maxbytes. Files are touched when they are read and the least
+    recently used ones are deleted once the cap is exceeded.
+
+    hits, misses, evictions and savedbytes (encoded bytes served from disk) are counted
+    for the lifetime of the object, see stats().
+    '''
+
+    def __init__(self, cache_dir='/opt/Microscope/DMD/cache/', maxbytes=2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.maxbytes = maxbytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.savedbytes = 0
+
+        entries = []
+        for name in os.listdir(cache_dir):
+            if name.endswith('.erle'):
+                stat = os.stat(os.path.join(cache_dir, name))
+                entries.append((stat.st_mtime, name[:-5], stat.st_size))
+        self.index = OrderedDict((key, size) for mtime, key, size in sorted(entries))
+        self.totalbytes = sum(self.index.values())
+
+    def _filename(self, key):
+        return os.path.join(self.cache_dir, key + '.erle')
+
+    def get(self, key):
+        '''
+        Returns (encoded bytes, size) for key or None if it is not cached
+        '''
+        if key not in self.index:
+            self.misses += 1
+            return None
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as fin:
+                encoded = bytearray(fin.read())
+        except FileNotFoundError:
+            self.totalbytes -= self.index.pop(key)
+            self.misses += 1
+            return None
+        os.utime(filename)
+        self.index.move_to_end(key)
+
+        self.hits += 1
+        self.savedbytes += len(encoded)
+        return encoded, len(encoded)
+
+    def put(self, key, encoded):
+        filename = self._filename(key)
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as fout:
+            fout.write(encoded)
+        os.replace(tmp_filename, filename)
+
+        if key in self.index:
+            self.totalbytes -= self.index.pop(key)
+        self.index[key] = len(encoded)
+        self.totalbytes += len(encoded)
+        self._evict()
+
+    def _evict(self):
+        while self.totalbytes > self.maxbytes and len(self.index) > 1:
+            key, size = self.index.popitem(last=False)
+            try:
+                os.remove(self._filename(key))
+            except FileNotFoundError:
+                pass
+            self.totalbytes -= size
+            self.evictions += 1
+
+    def clear(self):
+        for key in list(self.index.keys()):
+            try:
+                os.remove(self._filename(key))
+            except FileNotFoundError:
+                pass
+        self.index.clear()
+        self.totalbytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hitrate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'savedbytes': self.savedbytes,
+                'entries': len(self.index),
+                'totalbytes': self.totalbytes}
@@ -0,0 +1,193 @@
+import argparse
+import csv
+import os
+import numpy as np
+import cv2
+
+from microscope.PyCrafter import prepareframes
+
+'''
+Compiles a directory of DMD pattern images into a single sequence file which PyCrafter.dmd can
+upload with no decoding, merging or encoding at experiment time:
+
+python -m microscope.dmd_compile /opt/Microscope/DMD/gratings gratings.dmdseq --exposure 1000 --darktime 100
+
+dmd.defprecompiled(SequenceFile('gratings.dmdseq'))
+
+Patterns are the images in the directory in filename order, any non zero pixel is on. Exposure,
+dark time (us) and trigger settings are the same for every pattern unless a csv file is given
+with --settings, with one row per pattern and columns exposure, darktime, triggerin, triggerout
+(and optionally filename to match rows to images).
+
+File layout, all little endian, each part starting on a 4096 byte boundary so it can be mmapped:
+    header          HEADER_DTYPE
+    pattern table   PATTERN_DTYPE * numpatterns, the arguments of each dmd.definepattern call
+    frame table     FRAME_DTYPE * numframes, offset, size and groupkey of each encoded frame
+    frames          enhanced rle frames as sent to the dmd
+'''
+
+MAGIC = b'DMDSEQ01'
+ALIGN = 4096
+IMAGE_EXTENSIONS = ('.png', '.bmp', '.tif', '.tiff', '.jpg')
+
+HEADER_DTYPE = np.dtype([('magic', 'S8'), ('numpatterns', '<u4'), ('numframes', '<u4'), ('repeat', '<u4'),
+                         ('width', '<u2'), ('height', '<u2'), ('patterns', '<u8'), ('frames', '<u8')])
+
+PATTERN_DTYPE = np.dtype([('exposure', '<u4'), ('darktime', '<u4'), ('bitdepth', 'u1'), ('color', 'u1'),
+                          ('triggerin', 'u1'), ('triggerout', 'u1'), ('frame', '<u2'), ('bit', '<u2')])
+
+FRAME_DTYPE = np.dtype([('offset', '<u8'), ('size', '<u4'), ('key', 'S40')])
+
+
+def _aligned(position):
+    return position + (-position % ALIGN)
+
+
+def pattern_filenames(directory):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def load_patterns(filenames):
+    '''
+    Generator of the binary patterns in filenames, one (rows, columns) boolean array at a time
+    '''
+    for filename in filenames:
+        image = cv2.imread(filename, cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            raise IOError('Could not read pattern ' + filename)
+        yield image > 0
+
+
+def load_settings(filename, filenames):
+    '''
+    Reads per pattern exposure, darktime, triggerin and triggerout from a csv file, returning
+    a dict of lists in the order of filenames
+    '''
+    with open(filename, newline='') as fin:
+        rows = list(csv.DictReader(fin))
+    if rows and 'filename' in rows[0]:
+        byname = {row['filename']: row for row in rows}
+        rows = [byname[os.path.basename(name)] for name in filenames]
+    if len(rows) != len(filenames):
+        raise ValueError(str(len(rows)) + ' rows of settings for ' + str(len(filenames)) + ' patterns')
+
+    return {'exposure': [int(row['exposure']) for row in rows],
+            'darktime': [int(row['darktime']) for row in rows],
+            'triggerin': [bool(int(row['triggerin'])) for row in rows],
+            'triggerout': [int(row['triggerout']) for row in rows]}
+
+
+def compile_sequence(filenames, output, exposure, darktime=0, triggerin=False, triggerout=1, repeat=0,
+                     processes=None, cache=None):
+    '''
+    Encodes the patterns in filenames and writes the sequence file output. exposure, darktime,
+    triggerin and triggerout are single values or one per pattern. repeat is the number of times
+    the sequence runs, 0 for ever.
+    '''
+    num = len(filenames)
+    settings = {'exposure': exposure, 'darktime': darktime, 'triggerin': triggerin, 'triggerout': triggerout}
+    for key, value in settings.items():
+        if np.ndim(value) == 0:
+            settings[key] = [value] * num
+        elif len(value) != num:
+            raise ValueError(key + ' has ' + str(len(value)) + ' values for ' + str(num) + ' patterns')
+
+    frames, keys = prepareframes(load_patterns(filenames), processes, cache, num=num)
+
+    patterns = np.zeros(num, dtype=PATTERN_DTYPE)
+    patterns['exposure'] = settings['exposure']
+    patterns['darktime'] = settings['darktime']
+    patterns['bitdepth'] = 1
+    patterns['color'] = 7
+    patterns['triggerin'] = settings['triggerin']
+    patterns['triggerout'] = settings['triggerout']
+    patterns['frame'] = np.arange(num) // 24
+    patterns['bit'] = np.arange(num) % 24
+
+    table = np.zeros(len(frames), dtype=FRAME_DTYPE)
+    patternstart = ALIGN
+    framestart = _aligned(patternstart + patterns.nbytes)
+    position = _aligned(framestart + table.nbytes)
+    for i, (encoded, size) in enumerate(frames):
+        table[i] = (position, size, keys[i].encode())
+        position = _aligned(position + size)
+
+    header = np.zeros(1, dtype=HEADER_DTYPE)
+    header[0] = (MAGIC, num, len(frames), repeat, 1920, 1080, patternstart, framestart)
+
+    with open(output, 'wb') as fout:
+        fout.write(header.tobytes())
+        fout.seek(patternstart)
+        fout.write(patterns.tobytes())
+        fout.seek(framestart)
+        fout.write(table.tobytes())
+        for (encoded, size), entry in zip(frames, table):
+            fout.seek(int(entry['offset']))
+            fout.write(encoded)
+        fout.truncate(position)
+
+    print('compiled', num, 'patterns into', len(frames), 'frames,', position, 'bytes:', output)
+    return output
+
+
+class SequenceFile:
+    '''
+    Memory mapped view of a compiled sequence file. Frames are read straight from the mapping
+    as they are uploaded.
+
+    patterns is a list of dmd.definepattern argument tuples, frames a list of memoryviews of
+    the encoded frames with their sizes in sizes and groupkeys in keys.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = np.memmap(filename, dtype='uint8', mode='r')
+        header = self.data[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)[0]
+        if header['magic'] != MAGIC:
+            raise ValueError(filename + ' is not a compiled DMD sequence')
+
+        self.repeat = int(header['repeat'])
+        self.shape = (int(header['height']), int(header['width']))
+        start = int(header['patterns'])
+        table = self.data[start:start + PATTERN_DTYPE.itemsize * int(header['numpatterns'])].view(PATTERN_DTYPE)
+        self.patterns = [(i, int(p['exposure']), int(p['bitdepth']), format(int(p['color']), '03b'),
+                          bool(p['triggerin']), int(p['darktime']), int(p['triggerout']),
+                          int(p['frame']), int(p['bit'])) for i, p in enumerate(table)]
+
+        start = int(header['frames'])
+        table = self.data[start:start + FRAME_DTYPE.itemsize * int(header['numframes'])].view(FRAME_DTYPE)
+        self.sizes = [int(entry['size']) for entry in table]
+        self.keys = [entry['key'].decode() for entry in table]
+        self.frames = [memoryview(self.data[int(entry['offset']):int(entry['offset']) + int(entry['size'])])
+                       for entry in table]
+
+    def __len__(self):
+        return len(self.patterns)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile a directory of DMD pattern images into a sequence file')
+    parser.add_argument('directory', help='directory of pattern images, used in filename order')
+    parser.add_argument('output', help='sequence file to write')
+    parser.add_argument('--exposure', type=int, default=1000, help='exposure of every pattern (us)')
+    parser.add_argument('--darktime', type=int, default=0, help='dark time after every pattern (us)')
+    parser.add_argument('--triggerin', action='store_true', help='wait for the input trigger before each pattern')
+    parser.add_argument('--triggerout', type=int, default=1, help='output trigger setting of every pattern')
+    parser.add_argument('--settings', help='csv file of per pattern exposure, darktime, triggerin, triggerout')
+    parser.add_argument('--repeat', type=int, default=0, help='times the sequence runs, 0 for ever')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='encoding processes, all cores by default (only when run with python -m)')
+    args = parser.parse_args()
+
+    filenames = pattern_filenames(args.directory)
+    if args.settings is not None:
+        settings = load_settings(args.settings, filenames)
+    else:
+        settings = {'exposure': args.exposure, 'darktime': args.darktime,
+                    'triggerin': args.triggerin, 'triggerout': args.triggerout}
+    compile_sequence(filenames, args.output, repeat=args.repeat, processes=args.processes, **settings)
+
+
+if __name__ == '__main__':
+    main()
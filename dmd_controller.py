@@ -0,0 +1,256 @@
+import asyncio
+import itertools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from microscope.PyCrafter import dmd, DMDUploadCancelled, DMDTimingError, plansequence
+from microscope.dmd_compile import pattern_filenames, load_patterns
+
+'''
+Non blocking front end to PyCrafter.dmd for GUIs.
+
+controller = DMDController(progress=on_progress, status=on_status)
+controller.connect()
+controller.upload('/opt/Microscope/DMD/gratings')
+controller.setleds(50, 0, None)
+controller.cancel()
+
+An asyncio event loop runs in a background thread and takes commands from a queue. Every usb call
+runs in a single worker thread, so the dmd sees one command at a time in the order they were
+queued, while encoding and uploads never block the caller. Each method returns a
+concurrent.futures.Future of the command.
+
+Commands with the same key replace each other while they wait in the queue, so dragging a
+slider only sends its latest value; the future of a replaced command is cancelled.
+
+progress(sent, size) is called while a frame uploads and status(message) as commands start,
+finish or fail. Both are called from the worker threads, a GUI has to pass them on to its own
+thread (e.g. with a Qt signal).
+'''
+
+LED_CURRENT_MAX = 255
+
+
+class DMDController:
+    def __init__(self, cache=None, device=None, progress=None, status=None):
+        self.cache = cache
+        self.device = device
+        self.progress = progress
+        self.status = status
+        self.dmd = None
+
+        ## settings of the next upload, changed by settiming and display
+        self.rate = None
+        self.exposure = 10000
+        self.darktime = 0
+        self.triggered = False
+        self.repeat = 0
+        self.numpatterns = 0
+
+        self.usb = ThreadPoolExecutor(max_workers=1)
+        self.pending = {}
+        self.keys = itertools.count()
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(started,), daemon=True)
+        self.thread.start()
+        started.wait()
+
+    def _run(self, started):
+        asyncio.set_event_loop(self.loop)
+        self.queue = asyncio.Queue()
+        self.worker = self.loop.create_task(self._work())
+        self.loop.call_soon(started.set)
+        self.loop.run_forever()
+
+    async def _work(self):
+        while True:
+            key = await self.queue.get()
+            if key is None:
+                break
+            if key not in self.pending:
+                continue
+            function, args, future = self.pending.pop(key)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = await self.loop.run_in_executor(self.usb, function, *args)
+            except DMDUploadCancelled as error:
+                self._status('cancelled: ' + str(error))
+                future.set_exception(error)
+            except Exception as error:
+                self._status('error: ' + str(error))
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def _queue(self, key, function, args, future):
+        if key in self.pending:
+            self.pending[key][2].cancel()
+        else:
+            self.queue.put_nowait(key)
+        self.pending[key] = (function, args, future)
+
+    def submit(self, function, *args, key=None):
+        '''
+        Queues function(*args) to run in the usb thread, returning a future of its result. A command
+        with the key of one still waiting replaces it.
+        '''
+        if key is None:
+            key = next(self.keys)
+        future = Future()
+        self.loop.call_soon_threadsafe(self._queue, key, function, args, future)
+
+        return future
+
+    def _status(self, message):
+        if self.status is not None:
+            self.status(message)
+
+    def _progress(self, sent, size):
+        if self.progress is not None:
+            self.progress(sent, size)
+
+    ## commands
+
+    def connect(self):
+        def connect():
+            self.dmd = dmd(self.cache, self.device)
+            self.dmd.progress = self._progress
+            self._status('connected')
+        return self.submit(connect, key='connect')
+
+    def _connected(self):
+        ## raised in the usb thread, so it is reported through status like any other failed command
+        if self.dmd is None:
+            raise RuntimeError('not connected to the dmd')
+
+    def _timing(self):
+        num = self.numpatterns
+        exp = [self.exposure] * num
+        ti = [self.triggered] * num
+        dt = [self.darktime] * num
+        to = [1] * num
+
+        return exp, ti, dt, to
+
+    def plan(self, numpatterns=None):
+        '''
+        PyCrafter.plansequence of the current settings for numpatterns patterns, by default those
+        last uploaded, with the frame sizes and throughput of the last upload when known
+        '''
+        if numpatterns is not None:
+            self.numpatterns = numpatterns
+        exp, ti, dt, to = self._timing()
+        sizes = None
+        throughput = None
+        if self.dmd is not None:
+            throughput = self.dmd.throughput
+            if self.dmd.sequence is not None and len(self.dmd.sequence['patterns']) == self.numpatterns:
+                sizes = self.dmd.sequence['sizes']
+
+        return plansequence(exp, ti, dt, 1, sizes, throughput, self.rate)
+
+    def _checkplan(self):
+        plan = self.plan()
+        if plan['problems']:
+            raise DMDTimingError(plan['problems'])
+        message = str(plan['patterns']) + ' patterns in ' + str(plan['frames']) + ' frames, '
+        if plan['triggered']:
+            message += 'triggered'
+        else:
+            message += str(round(plan['rate'], 1)) + ' Hz, cycle ' + str(round(plan['cycletime'] / 1000, 3)) + ' ms'
+        if plan['uploadtime'] is not None:
+            message += ', upload ' + ('~' if plan['estimated'] else '') + str(round(plan['uploadtime'], 1)) + ' s'
+        self._status(message)
+
+    def upload(self, directory, processes=None, verify=False):
+        '''
+        Encodes the patterns in directory (in filename order) and uploads them, sending only the
+        frames that changed since the last upload
+        '''
+        def upload():
+            self._connected()
+            filenames = pattern_filenames(directory)
+            self.numpatterns = len(filenames)
+            self._checkplan()
+            self.dmd.cancel.clear()
+            self._status('uploading ' + str(len(filenames)) + ' patterns')
+            exp, ti, dt, to = self._timing()
+            self.dmd.updatesequence(load_patterns(filenames), exp, ti, dt, to, self.repeat, processes, 1, verify)
+            self._status('uploaded ' + str(len(filenames)) + ' patterns')
+        return self.submit(upload, key='upload')
+
+    def cancel(self):
+        '''
+        Stops the upload running at the next package and drops one waiting in the queue
+        '''
+        if self.dmd is not None:
+            self.dmd.cancel.set()
+
+        def drop():
+            if 'upload' in self.pending:
+                self.pending.pop('upload')[2].cancel()
+        self.loop.call_soon_threadsafe(drop)
+
+    def setleds(self, red, green, blue):
+        '''
+        Sets the led currents in percent, None turns the led off
+        '''
+        def setleds():
+            self._connected()
+            values = [red, green, blue]
+            self.dmd.setledcurrents(*[round(value * LED_CURRENT_MAX / 100) if value is not None else 0
+                                      for value in values])
+            self.dmd.setleds(*[value is not None for value in values])
+        return self.submit(setleds, key='leds')
+
+    def settiming(self, rate, exposure, triggered):
+        '''
+        Sets the pattern rate (Hz) and exposure (us) of every pattern, or waits for the input trigger
+        before each pattern if triggered. Applied to the sequence on the dmd if there is one, settings
+        it cannot run raise DMDTimingError before anything is sent.
+        '''
+        def settiming():
+            self._connected()
+            if not triggered and not rate > 0:
+                raise ValueError('pattern rate ' + str(rate) + ' Hz, it must be above 0')
+            previous = (self.rate, self.exposure, self.triggered, self.darktime)
+            self.rate = None if triggered else rate
+            self.exposure = int(exposure)
+            self.triggered = bool(triggered)
+            self.darktime = 0 if triggered else max(int(1e6 / rate) - self.exposure, 0)
+            if self.numpatterns:
+                try:
+                    self._checkplan()
+                except DMDTimingError:
+                    self.rate, self.exposure, self.triggered, self.darktime = previous
+                    raise
+            if self.dmd.sequence is not None:
+                exp, ti, dt, to = self._timing()
+                self.dmd.settiming(exp, ti, dt)
+        return self.submit(settiming, key='timing')
+
+    def display(self, mode):
+        '''
+        mode 'off' stops the sequence, 'on' runs it once and 'cycle' repeats it until stopped
+        '''
+        def display():
+            self._connected()
+            self.dmd.stopsequence()
+            if mode == 'off':
+                return
+            self.repeat = 0 if mode == 'cycle' else 1
+            if self.dmd.sequence is not None:
+                num = self.dmd.sequence['lut'][0]
+                self.dmd.configurelut(num, self.repeat)
+                self.dmd.sequence['lut'] = (num, self.repeat)
+                self.dmd.startsequence()
+        return self.submit(display, key='display')
+
+    def close(self):
+        self.cancel()
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+        self.loop.call_soon_threadsafe(self.worker.add_done_callback, lambda task: self.loop.stop())
+        self.thread.join()
+        self.usb.shutdown(wait=False)
@@ -0,0 +1,152 @@
+import functools
+import numpy as np
+
+'''
+Generators of the binary patterns projected with the DMD: gratings, spot arrays, annuli,
+checkerboards and random masks.
+
+Patterns are built from cached coordinate grids by broadcasting, and are returned with the
+smallest shape that broadcasts to the full frame: a vertical grating is a single (1, columns)
+row, a horizontal one a (rows, 1) column. packedplane turns a pattern into the packed bit-plane
+(rows, columns / 8) that PyCrafter.prepareframes takes, and packframes ors patterns straight into
+24 bit frames, so neither makes a full resolution uint8 image per pattern.
+
+patterns = gratings(period=12, steps=3) + [spots(pitch=40, radius=3)]
+dmd.defsequence([packedplane(p) for p in patterns], exp, ti, dt, to, rep)
+'''
+
+SHAPE = (1080, 1920)
+
+
+@functools.lru_cache(maxsize=8)
+def coordinates(shape=SHAPE):
+    '''
+    Returns the pixel coordinates (y (rows, 1), x (1, columns)) of a frame. The arrays are cached
+    and read only.
+    '''
+    y, x = np.ogrid[:shape[0], :shape[1]]
+    y = y.astype('float64')
+    x = x.astype('float64')
+    y.flags.writeable = False
+    x.flags.writeable = False
+
+    return y, x
+
+
+def _centre(center, shape):
+    if center is None:
+        return (shape[0] - 1) / 2, (shape[1] - 1) / 2
+    return center
+
+
+def grating(period, angle=0, phase=0, duty=0.5, shape=SHAPE):
+    '''
+    Binary grating of period pixels. angle is the direction of the stripes in degrees, 0 for
+    vertical stripes, phase is in periods and duty the fraction of each period that is on.
+    Vertical and horizontal gratings are returned as a single row or column.
+    '''
+    y, x = coordinates(shape)
+    angle = angle % 180
+    if angle == 0:
+        position = x
+    elif angle == 90:
+        position = y
+    else:
+        theta = np.deg2rad(angle)
+        position = x * np.cos(theta) + y * np.sin(theta)
+
+    return (position / period + phase) % 1 < duty
+
+
+def gratings(period, steps=3, angle=0, duty=0.5, shape=SHAPE):
+    '''
+    List of steps gratings shifted by equal fractions of a period, as used for structured
+    illumination
+    '''
+    return [grating(period, angle, step / steps, duty, shape) for step in range(steps)]
+
+
+def spots(pitch, radius, offset=(0, 0), shape=SHAPE):
+    '''
+    Square grid of discs of radius pixels, pitch pixels apart. offset (rows, columns) moves the
+    grid, a disc is centred on offset.
+    '''
+    y, x = coordinates(shape)
+    dy = (y - offset[0] + pitch / 2) % pitch - pitch / 2
+    dx = (x - offset[1] + pitch / 2) % pitch - pitch / 2
+
+    return dy ** 2 + dx ** 2 <= radius ** 2
+
+
+def annulus(inner, outer, center=None, shape=SHAPE):
+    '''
+    Ring between the radii inner and outer around center (row, column), by default the centre
+    of the frame. An inner radius of 0 gives a disc.
+    '''
+    y, x = coordinates(shape)
+    cy, cx = _centre(center, shape)
+    r2 = (y - cy) ** 2 + (x - cx) ** 2
+
+    return (r2 >= inner ** 2) & (r2 <= outer ** 2)
+
+
+def checkerboard(size, phase=0, shape=SHAPE):
+    '''
+    Checkerboard of size pixel squares, phase 1 swaps the black and white squares
+    '''
+    y, x = np.ogrid[:shape[0], :shape[1]]
+
+    return (y // size + x // size + phase) % 2 == 1
+
+
+def randommask(fill=0.5, block=1, seed=None, shape=SHAPE):
+    '''
+    Random binary mask with fill the fraction of pixels on, made of block x block pixel squares
+    '''
+    rng = np.random.default_rng(seed)
+    height = -(-shape[0] // block)
+    width = -(-shape[1] // block)
+    mask = rng.random((height, width)) < fill
+    if block > 1:
+        mask = np.broadcast_to(mask[:, None, :, None], (height, block, width, block))
+        mask = mask.reshape(height * block, width * block)[:shape[0], :shape[1]]
+
+    return mask
+
+
+def packedplane(pattern, shape=SHAPE):
+    '''
+    Packs a pattern into the bit-plane layout (rows, columns / 8) taken by PyCrafter.packgroup.
+    Rows and columns are packed once and broadcast, so a grating costs a single packed row.
+    '''
+    pattern = np.asarray(pattern, dtype=bool)
+    if pattern.ndim != 2:
+        raise ValueError('pattern must be two dimensional, got shape ' + str(pattern.shape))
+    if pattern.shape[1] == 1:
+        packed = pattern.view('uint8') * np.uint8(0xff)
+    else:
+        packed = np.packbits(np.broadcast_to(pattern, (pattern.shape[0], shape[1])), axis=-1)
+
+    return np.broadcast_to(packed, (shape[0], shape[1] // 8))
+
+
+def packframes(patterns, shape=SHAPE):
+    '''
+    Generator of 24 bit frames (rows, columns, 3) holding up to 24 patterns each, in the bit
+    order of PyCrafter.packimages. Each pattern is shifted and or'ed into its colour byte at its
+    own shape, so a grating only costs a row.
+    '''
+    channels = np.zeros((3,) + shape, dtype='uint8')
+    count = 0
+    for pattern in patterns:
+        plane = np.asarray(pattern, dtype=bool).view('uint8')
+        channel = channels[2 - (count % 24) // 8]
+        np.bitwise_or(channel, plane << np.uint8(count % 8), out=channel)
+        count += 1
+
+        if count % 24 == 0:
+            yield np.ascontiguousarray(channels.transpose(1, 2, 0))
+            channels[:] = 0
+
+    if count % 24 != 0:
+        yield np.ascontiguousarray(channels.transpose(1, 2, 0))
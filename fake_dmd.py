@@ -0,0 +1,82 @@
+import struct
+import time
+import usb.core
+
+
+class FakeDMD:
+    '''
+    Stand in for the usb.core device of a DLPC900, to run PyCrafter.dmd without the hardware.
+
+    dmd = PyCrafter.dmd(dev=FakeDMD())
+
+    Every 64 byte report written is kept in writes and reassembled into commands, which are
+    kept in commands as (flags, sequence byte, command code, payload). Commands asking for
+    a reply queue one for read(). Bitmap packages (command 0x1a2b) are counted in packets.
+
+    Errors can be injected to test the upload:
+        failwrite  - set of bitmap package indices whose write raises usb.core.USBError
+        errorafter - bitmap package index from which the error status (0x0100) reports errorcode
+
+    latency is the time in seconds each read takes, standing in for the usb round trip.
+    '''
+
+    def __init__(self, failwrite=(), errorafter=None, errorcode=1, latency=0.0, keepwrites=True):
+        self.failwrite = set(failwrite)
+        self.errorafter = errorafter
+        self.errorcode = errorcode
+        self.latency = latency
+        self.keepwrites = keepwrites
+
+        self.writes = []
+        self.commands = []
+        self.replies = []
+        self.packets = 0
+        self.byteswritten = 0
+        self._pending = None
+
+    def set_configuration(self):
+        pass
+
+    def write(self, endpoint, data):
+        data = bytes(data)
+        self.byteswritten += len(data)
+        if self.keepwrites:
+            self.writes.append(data)
+
+        if self._pending is None:
+            flags, sequencebyte, length, com2, com1 = struct.unpack_from('<BBHBB', data)
+            self._pending = [flags, sequencebyte, (com1 << 8) | com2, bytearray(data[6:6 + length - 2]),
+                             length - 2]
+        else:
+            self._pending[3] += data[:self._pending[4] - len(self._pending[3])]
+
+        if len(self._pending[3]) >= self._pending[4]:
+            command = self._pending[:4]
+            self._pending = None
+            self._complete(*command)
+
+        return len(data)
+
+    def _complete(self, flags, sequencebyte, code, payload):
+        if code == 0x1a2b:
+            packet = self.packets
+            self.packets += 1
+            if packet in self.failwrite:
+                raise usb.core.USBError('injected write failure at package ' + str(packet))
+
+        if self.keepwrites:
+            self.commands.append((flags, sequencebyte, code, bytes(payload)))
+
+        if flags & 0x40:
+            reply = bytearray(64)
+            struct.pack_into('<BBH', reply, 0, flags, sequencebyte, 4)
+            if code == 0x0100 and self.errorafter is not None and self.packets > self.errorafter:
+                reply[6] = self.errorcode
+            self.replies.append(reply)
+
+    def read(self, endpoint, length, timeout=None):
+        if self.latency:
+            time.sleep(self.latency)
+        if not self.replies:
+            raise usb.core.USBError('read timed out, no reply was requested')
+        return self.replies.pop(0)
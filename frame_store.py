@@ -0,0 +1,255 @@
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+'''
+Compressed in-RAM store of grabbed frames, so a run can be several times longer than the
+framegrabber buffer allows before frames have to go to disk.
+
+store = FrameStore((1024, 1280), codec='lz4', delta=True)
+recorder = StreamRecorder(cam.buffer, store)    # drains the grab buffer into the store
+...
+frame = store[1500]                             # by SiSo picture number
+for frames in store.chunks(1000, 2000):
+    ...
+
+Frames are compressed one by one on a thread pool as the recorder hands them over (zlib and
+lz4 both release the GIL). With delta=True each frame is stored as its difference (modulo 256)
+from the previous one, which compresses far better when most of the scene is static, as in DIC;
+every keyframe frames, and after any gap, a frame is stored whole so a frame is never more than
+keyframe - 1 differences away from one that can be decoded on its own. Decoding is lazy and
+remembers the last frame, so reading frames in order costs one decompression each.
+
+The store is a longer ring: once it holds max_bytes of compressed frames the oldest frames (a
+keyframe and the differences depending on it) are discarded to make room. max_bytes defaults to
+MEMORY_FRACTION of the physical RAM, so a grab that never ends cannot use up the memory.
+
+Frames the recorder lost to buffer overruns are gaps in the picture numbers, kept in gaps.
+missing(start, stop) lists the frames of a range that are not held, and chunks refuses a range
+with any before yielding a frame. lz4 needs the lz4 package, zlib is always available. Frames from the camera are already 8 bit, so there is no bit depth packing to
+do before compression; unused grey levels are taken out by the codec.
+'''
+
+CODECS = ('zlib', 'lz4')
+## default max_bytes, as a fraction of the physical RAM
+MEMORY_FRACTION = 0.5
+
+
+def physical_memory():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+class FrameStore:
+    def __init__(self, frame_size, startframe=1, codec='zlib', level=1, delta=False, keyframe=50, max_bytes=None,
+                 workers=4, settings=None):
+        '''
+        frame_size is (height, width) of the uint8 frames, startframe the picture number of the first frame added.
+        level is the compression level of the codec, keyframe how often a frame is stored whole with delta and
+        max_bytes the most compressed bytes kept (None for MEMORY_FRACTION of the physical RAM)
+        '''
+        if codec not in CODECS:
+            raise ValueError('Unknown codec ' + str(codec) + ', use one of ' + str(CODECS))
+        if codec == 'lz4' and lz4 is None:
+            raise ImportError('the lz4 package is needed for codec lz4')
+        self.frame_size = tuple(frame_size)
+        self.codec = codec
+        self.level = level
+        self.delta = delta
+        self.keyframe = max(int(keyframe), 1)
+        if max_bytes is None:
+            max_bytes = int(MEMORY_FRACTION * physical_memory())
+        self.max_bytes = max_bytes
+        self.startframe = startframe
+        self.metadata = {'height': frame_size[0], 'width': frame_size[1], 'codec': codec, 'delta': delta,
+                         'settings': settings}
+
+        ## picture number: (compressed bytes, whether it is a keyframe)
+        self.frames = OrderedDict()
+        ## (first, last) picture numbers skipped
+        self.gaps = []
+        self.next = startframe
+        self.nbytes = 0
+        self.evicted = 0
+        self.previous = None
+        self.decoded = None
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(workers)
+
+    def _compress(self, frame):
+        if self.codec == 'lz4':
+            return lz4.compress(frame, compression_level=self.level)
+        return zlib.compress(frame, self.level)
+
+    def _decompress(self, data):
+        if self.codec == 'lz4':
+            data = lz4.decompress(data)
+        else:
+            data = zlib.decompress(data)
+        return np.frombuffer(data, dtype='uint8').reshape(self.frame_size)
+
+    def add_frames(self, frames):
+        '''
+        Compresses frames, numbered on from the last frame added or skipped
+        '''
+        frames = np.asarray(frames, dtype='uint8')
+        if frames.shape[1:] != self.frame_size:
+            raise ValueError('frames of shape ' + str(frames.shape[1:]) + ', expected ' + str(self.frame_size))
+        if len(frames) == 0:
+            return
+        numbers = range(self.next, self.next + len(frames))
+        keys = [(number - self.startframe) % self.keyframe == 0 for number in numbers]
+        if self.delta:
+            previous = frames[:1] if self.previous is None else self.previous[np.newaxis]
+            keys[0] = keys[0] or self.previous is None
+            encoded = np.subtract(frames, np.concatenate((previous, frames[:-1])))
+            encoded[keys] = frames[keys]
+            self.previous = frames[-1].copy()
+        else:
+            encoded = frames
+            keys = [True] * len(frames)
+
+        blobs = list(self.pool.map(self._compress, np.ascontiguousarray(encoded)))
+        with self.lock:
+            for number, blob, key in zip(numbers, blobs, keys):
+                self.frames[number] = (blob, key)
+                self.nbytes += len(blob)
+            self.next += len(frames)
+            self._evict()
+
+    def add_frame(self, frame):
+        self.add_frames(np.asarray(frame)[np.newaxis])
+
+    def skip(self, first, last):
+        '''
+        Frames first to last were lost, the next frame added is last + 1 and is stored whole
+        '''
+        with self.lock:
+            if self.gaps and self.gaps[-1][1] == first - 1:
+                first = self.gaps.pop()[0]
+            self.gaps.append((first, last))
+        self.next = last + 1
+        self.previous = None
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and len(self.frames) > 1:
+            number, (blob, key) = self.frames.popitem(last=False)
+            self.nbytes -= len(blob)
+            self.evicted += 1
+            ## the differences that depended on it go too
+            while self.frames and not next(iter(self.frames.values()))[1]:
+                number, (blob, key) = self.frames.popitem(last=False)
+                self.nbytes -= len(blob)
+                self.evicted += 1
+
+    def first(self):
+        '''
+        Number of the oldest frame held, None if there are none
+        '''
+        with self.lock:
+            return next(iter(self.frames), None)
+
+    def last(self):
+        '''
+        Number of the newest frame held, None if there are none
+        '''
+        with self.lock:
+            return next(reversed(self.frames), None)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __contains__(self, frame):
+        return frame in self.frames
+
+    @property
+    def ratio(self):
+        '''
+        Compression ratio of the frames held
+        '''
+        if self.nbytes == 0:
+            return None
+        return len(self.frames) * int(np.prod(self.frame_size)) / self.nbytes
+
+    def __getitem__(self, frame):
+        frame = int(frame)
+        with self.lock:
+            if frame not in self.frames:
+                raise IndexError('Frame ' + str(frame) + ' is not in the store')
+            if self.decoded is not None and self.decoded[0] == frame:
+                return self.decoded[1]
+            ## walk back to the keyframe, or to the frame decoded last
+            chain = [frame]
+            while not self.frames[chain[-1]][1]:
+                if self.decoded is not None and self.decoded[0] == chain[-1] - 1:
+                    break
+                chain.append(chain[-1] - 1)
+            blobs = [self.frames[number] for number in reversed(chain)]
+            decoded = self.decoded
+
+        image = None
+        for blob, key in blobs:
+            data = self._decompress(blob)
+            if key:
+                image = data
+            else:
+                image = np.add(decoded[1] if image is None else image, data)
+        image.flags.writeable = False
+        self.decoded = (frame, image)
+        return image
+
+    def missing(self, start, stop):
+        '''
+        (first, last) ranges of the pictures start to stop - 1 that are not held: discarded, lost or
+        not grabbed yet
+        '''
+        with self.lock:
+            first = next(iter(self.frames), None)
+            last = next(reversed(self.frames), None)
+            gaps = sorted(self.gaps)
+        if first is None:
+            return [(start, stop - 1)] if stop > start else []
+        gaps = [(start, first - 1)] + gaps + [(last + 1, stop - 1)]
+        return [(max(a, start), min(b, stop - 1)) for a, b in gaps if max(a, start) <= min(b, stop - 1)]
+
+    def segments(self, start, stop):
+        '''
+        (first, stop) ranges of the pictures start to stop - 1 that are held, split at the gaps
+        '''
+        segments = []
+        for a, b in self.missing(start, stop) + [(stop, stop)]:
+            if a > start:
+                segments.append((start, a))
+            start = b + 1
+        return segments
+
+    def chunks(self, start, stop, chunk=64):
+        '''
+        Generator of arrays of at most chunk frames covering pictures start to stop - 1. Raises
+        IndexError straight away if any of them are missing
+        '''
+        missing = self.missing(start, stop)
+        if missing:
+            raise IndexError('Frames ' + ', '.join(str(a) + ' to ' + str(b) for a, b in missing) +
+                             ' are not in the store')
+        return self._chunks(start, stop, chunk)
+
+    def _chunks(self, start, stop, chunk):
+        for first in range(start, stop, chunk):
+            yield np.stack([self[number] for number in range(first, min(first + chunk, stop))])
+
+    def close(self):
+        '''
+        Called by the recorder when it stops, the frames stay readable
+        '''
+        self.pool.shutdown()
+        print('stored', len(self.frames), 'frames in', round(self.nbytes / 1e6, 1), 'MB',
+              '' if self.ratio is None else 'compressed ' + str(round(self.ratio, 1)) + ' times,',
+              self.evicted, 'discarded to stay under max_bytes')
@@ -0,0 +1,70 @@
+import numpy as np
+
+'''
+Reduction of frames on their way to a writer, so a sub-region, binned frames or every Nth frame
+is saved in one pass instead of cutting down a full sensor video afterwards.
+
+transform = FrameTransform(crop=(256, 0, 512, 512), bin=2, stride=5)
+cam.set_transform(crop=(256, 0, 512, 512), bin=2, stride=5)   # for save_vid and streaming
+
+frames = transform(block, offset)
+
+Each call works on a whole (n, height, width) block of frames with array slicing and one
+reshaped sum, never frame by frame. offset is the position of the first frame of the block in
+the recording, so stride keeps frames 0, stride, 2 * stride ... of the recording however it is
+split into blocks. crop is (x offset, y offset, width, height) like the camera ROI in
+frameformat, bin averages bin x bin pixel blocks (trimming edges that do not fill a block,
+as reduce_frame does) and dtype is the dtype of the frames written. Compressed video needs uint8;
+the raw formats take any dtype, e.g. float32 to keep the binned means exact.
+'''
+
+
+class FrameTransform:
+    def __init__(self, crop=None, bin=1, stride=1, dtype='uint8'):
+        if bin < 1 or stride < 1:
+            raise ValueError('bin and stride must be at least 1')
+        self.crop = None if crop is None else tuple(int(value) for value in crop)
+        self.bin = int(bin)
+        self.stride = int(stride)
+        self.dtype = np.dtype(dtype)
+
+    def settings(self):
+        '''
+        Dict of the transform, saved in the metadata of raw recordings
+        '''
+        return {'crop': self.crop, 'bin': self.bin, 'stride': self.stride, 'dtype': self.dtype.str}
+
+    def frame_size(self, frame_size):
+        '''
+        (height, width) of the output for input frames of frame_size
+        '''
+        height, width = frame_size
+        if self.crop is not None:
+            x, y, crop_width, crop_height = self.crop
+            if x < 0 or y < 0 or x + crop_width > width or y + crop_height > height:
+                raise ValueError('crop ' + str(self.crop) + ' is outside the ' + str(width) + ' x ' + str(height) +
+                                 ' frame')
+            height, width = crop_height, crop_width
+        return height // self.bin, width // self.bin
+
+    def count(self, numframes, offset=0):
+        '''
+        Number of the numframes frames from offset that are kept
+        '''
+        return len(range((-offset) % self.stride, numframes, self.stride))
+
+    def __call__(self, frames, offset=0):
+        frames = frames[(-offset) % self.stride::self.stride]
+        if self.crop is not None:
+            x, y, width, height = self.crop
+            frames = frames[:, y:y + height, x:x + width]
+        if self.bin > 1:
+            height = frames.shape[1] // self.bin
+            width = frames.shape[2] // self.bin
+            blocks = frames[:, :height * self.bin, :width * self.bin].reshape(len(frames), height, self.bin, width,
+                                                                                self.bin)
+            sums = blocks.sum(axis=(2, 4), dtype='uint32')
+            if self.dtype.kind == 'f':
+                return (sums / (self.bin * self.bin)).astype(self.dtype)
+            return (sums // (self.bin * self.bin)).astype(self.dtype)
+        return np.ascontiguousarray(frames, dtype=self.dtype)
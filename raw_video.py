@@ -0,0 +1,164 @@
+import json
+import os
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+'''
+Lossless recording of camera frames, as an alternative to mp4 through Generic.video.WriteVideo.
+
+writer = raw_writer('/home/ppzmis/Videos/run.npy', frame_size=(1024, 1280), settings=cam.camset.cam_dict)
+writer.add_frames(frames)
+writer.close()
+
+video = RawVideo('/home/ppzmis/Videos/run.npy')
+frame = video[100]
+
+.npy files are a standard numpy stack (frames, height, width), written frame block by frame
+block straight from the buffer and read back with np.load(filename, mmap_mode='r'). The header
+is padded to 4096 bytes and rewritten with the final shape on close, so the length does not
+have to be known in advance. Metadata (geometry, cam_dict settings, and anything added to
+writer.metadata such as dropped frames) goes in a .json file of the same name.
+
+.h5/.hdf5 files hold a chunked dataset 'frames' (one chunk per chunkframes frames) and the
+metadata as json in its attribute 'metadata'. They need h5py.
+'''
+
+RAW_EXTENSIONS = ('.npy', '.h5', '.hdf5')
+NPY_HEADER = 4096
+
+
+def raw_writer(filename, frame_size, settings=None, **kwargs):
+    '''
+    Returns the writer for the extension of filename
+    '''
+    if filename.endswith('.npy'):
+        return NpyWriter(filename, frame_size, settings, **kwargs)
+    if filename.endswith(('.h5', '.hdf5')):
+        return HDF5Writer(filename, frame_size, settings, **kwargs)
+    raise ValueError('No raw format for ' + filename + ', use one of ' + str(RAW_EXTENSIONS))
+
+
+def _metadata(frame_size, settings, dtype):
+    return {'height': frame_size[0], 'width': frame_size[1], 'dtype': np.dtype(dtype).str,
+            'settings': settings}
+
+
+class NpyWriter:
+    def __init__(self, filename, frame_size, settings=None, dtype='uint8'):
+        self.filename = filename
+        self.frame_size = tuple(frame_size)
+        self.dtype = np.dtype(dtype)
+        self.metadata = _metadata(frame_size, settings, dtype)
+        self.numframes = 0
+        self.file = open(filename, 'wb')
+        self._write_header()
+
+    def _write_header(self):
+        header = repr({'descr': self.dtype.str, 'fortran_order': False,
+                       'shape': (self.numframes,) + self.frame_size})
+        header = header.ljust(NPY_HEADER - 10 - 1) + '\n'
+        self.file.seek(0)
+        self.file.write(b'\x93NUMPY\x01\x00' + len(header).to_bytes(2, 'little') + header.encode('latin1'))
+
+    def add_frames(self, frames):
+        frames = np.ascontiguousarray(frames, dtype=self.dtype)
+        if frames.shape[1:] != self.frame_size:
+            raise ValueError('frames of shape ' + str(frames.shape[1:]) + ', expected ' + str(self.frame_size))
+        if len(frames) == 0:
+            return
+        self.file.write(memoryview(frames).cast('B'))
+        self.numframes += len(frames)
+
+    def add_frame(self, frame):
+        self.add_frames(np.asarray(frame)[np.newaxis])
+
+    def close(self):
+        if self.file.closed:
+            return
+        self._write_header()
+        self.file.close()
+        self.metadata['numframes'] = self.numframes
+        with open(os.path.splitext(self.filename)[0] + '.json', 'w') as fout:
+            json.dump(self.metadata, fout)
+
+
+class HDF5Writer:
+    def __init__(self, filename, frame_size, settings=None, dtype='uint8', chunkframes=16, compression=None):
+        if h5py is None:
+            raise ImportError('h5py is needed to write ' + filename)
+        self.filename = filename
+        self.frame_size = tuple(frame_size)
+        self.metadata = _metadata(frame_size, settings, dtype)
+        self.numframes = 0
+        self.file = h5py.File(filename, 'w')
+        self.dataset = self.file.create_dataset('frames', shape=(0,) + self.frame_size, dtype=dtype,
+                                                maxshape=(None,) + self.frame_size,
+                                                chunks=(chunkframes,) + self.frame_size, compression=compression)
+
+    def add_frames(self, frames):
+        frames = np.asarray(frames)
+        if frames.shape[1:] != self.frame_size:
+            raise ValueError('frames of shape ' + str(frames.shape[1:]) + ', expected ' + str(self.frame_size))
+        if len(frames) == 0:
+            return
+        self.dataset.resize(self.numframes + len(frames), axis=0)
+        self.dataset[self.numframes:] = frames
+        self.numframes += len(frames)
+
+    def add_frame(self, frame):
+        self.add_frames(np.asarray(frame)[np.newaxis])
+
+    def close(self):
+        if not self.file:
+            return
+        self.metadata['numframes'] = self.numframes
+        self.dataset.attrs['metadata'] = json.dumps(self.metadata)
+        self.file.close()
+
+
+class RawVideo:
+    '''
+    Lazy reader of a raw recording: frames are read from disk as they are indexed. video[n] is
+    frame n (from 0), video[a:b] an array of frames, and metadata the dict saved with the file.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        if filename.endswith('.npy'):
+            self.file = None
+            self.frames = np.load(filename, mmap_mode='r')
+            jsonname = os.path.splitext(filename)[0] + '.json'
+            if os.path.exists(jsonname):
+                with open(jsonname) as fin:
+                    self.metadata = json.load(fin)
+            else:
+                self.metadata = {}
+        elif filename.endswith(('.h5', '.hdf5')):
+            if h5py is None:
+                raise ImportError('h5py is needed to read ' + filename)
+            self.file = h5py.File(filename, 'r')
+            self.frames = self.file['frames']
+            self.metadata = json.loads(self.frames.attrs.get('metadata', '{}'))
+        else:
+            raise ValueError('No raw format for ' + filename + ', use one of ' + str(RAW_EXTENSIONS))
+
+        self.numframes, self.height, self.width = self.frames.shape
+        self.settings = self.metadata.get('settings')
+
+    def __len__(self):
+        return self.numframes
+
+    def __getitem__(self, item):
+        return self.frames[item]
+
+    def __iter__(self):
+        for n in range(self.numframes):
+            yield self.frames[n]
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
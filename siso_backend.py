@@ -0,0 +1,35 @@
+import importlib
+import os
+
+'''
+The framegrabber interface used by the camera modules:
+
+from microscope.siso_backend import SISO
+
+is the Silicon Software SiSoPyInterface by default. Setting the environment variable
+MICROSCOPE_SISO before the camera modules are imported plugs in another module with the same
+functions, 'sim' for the in-process simulator microscope.siso_sim:
+
+MICROSCOPE_SISO=sim python -m microscope.camera_gui
+
+The backend is imported the first time SISO is looked up, so modules that are handed another
+backend (camera_buffer, siso_sim's load test) never need SiSoPyInterface.
+'''
+
+BACKEND = os.environ.get('MICROSCOPE_SISO', '')
+
+
+def load_backend():
+    if BACKEND.lower() in ('sim', 'simulator'):
+        return importlib.import_module('microscope.siso_sim')
+    if BACKEND:
+        return importlib.import_module(BACKEND)
+    return importlib.import_module('SiSoPyInterface')
+
+
+def __getattr__(name):
+    if name == 'SISO':
+        global SISO
+        SISO = load_backend()
+        return SISO
+    raise AttributeError('module ' + __name__ + ' has no attribute ' + name)
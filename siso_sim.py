@@ -0,0 +1,297 @@
+import re
+import threading
+import time
+import numpy as np
+
+'''
+In-process simulator of the SiSoPyInterface calls used by the camera modules, so Camera,
+CameraSettings and the GUIs run without the Silicon Software runtime or a microEnable board.
+Select it with MICROSCOPE_SISO=sim, see siso_backend.
+
+Fg_AcquireEx starts a thread writing synthetic frames (particles moving across a noisy
+background) into the Fg_AllocMemEx buffer at FG_FRAMESPERSEC, with the ROI of FG_WIDTH and
+FG_HEIGHT. Picture numbers, the ring buffer layout, blocking waits and image pointers behave as
+on the board, so acquisition and saving can be load tested at realistic rates. If frames cannot
+be drawn as fast as the frame rate the simulator falls behind, frames_behind counts the shortfall.
+
+Camera commands written by CameraSettings are read by simulate_cam_commands instead of being
+sent down the camera link: frame rate (#r), exposure (#e) and ROI (#R) set the framegrabber
+parameters.
+
+python -m microscope.siso_sim --fps 2000 --numpics 5000 streams a simulated grab to a .npy file
+and reports the frames saved and lost. It always uses the simulator, whatever MICROSCOPE_SISO
+is, and needs only numpy.
+'''
+
+SIMULATED = True
+
+FG_OK = 0
+FG_TIMEOUT_ERR = -2120
+FG_TRANSFER_NOT_ACTIVE = -2010
+GRAB_INFINITE = -1
+ACQ_STANDARD = 0x1
+
+FG_WIDTH = 100
+FG_HEIGHT = 200
+FG_XOFFSET = 300
+FG_YOFFSET = 400
+FG_FRAMESPERSEC = 2100
+FG_EXPOSURE = 10020
+
+DEFAULT_PARAMETERS = {FG_WIDTH: 1280, FG_HEIGHT: 1024, FG_XOFFSET: 0, FG_YOFFSET: 0,
+                      FG_FRAMESPERSEC: 400, FG_EXPOSURE: 1000}
+
+
+class Scene:
+    '''
+    Synthetic images: particles of the given radius moving in straight lines at up to speed
+    pixels per frame and wrapping at the edges, on a background with gaussian noise. Frame n
+    is the same whenever it is drawn.
+    '''
+
+    def __init__(self, width, height, particles=50, radius=4, speed=2.0, background=40, noise=8,
+                 brightness=200, seed=0):
+        rng = np.random.default_rng(seed)
+        self.width = width
+        self.height = height
+        size = 2 * radius + 1
+        self.size = size
+        self.room = np.array([max(width - size, 1), max(height - size, 1)])
+        self.start = rng.random((particles, 2)) * self.room
+        self.velocity = (rng.random((particles, 2)) - 0.5) * 2 * speed
+        y, x = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+        self.sprite = (brightness * np.exp(-(x ** 2 + y ** 2) / (radius ** 2 / 2))).astype('uint8')
+        self.noise = np.clip(background + rng.normal(0, noise, (8, height, width)), 0, 255).astype('uint8')
+
+    def draw(self, n, out):
+        np.copyto(out, self.noise[n % len(self.noise)])
+        if self.size > min(self.width, self.height):
+            return
+        positions = ((self.start + self.velocity * n) % self.room).astype(int)
+        for x, y in positions:
+            region = out[y:y + self.size, x:x + self.size]
+            np.maximum(region, self.sprite, out=region)
+
+
+class MemoryHandle:
+    def __init__(self, size, numbuffers):
+        self.array = np.zeros(size, dtype='uint8')
+        self.numbuffers = numbuffers
+        self.subsize = size // numbuffers
+
+
+class ImagePtr:
+    def __init__(self, memory, offset):
+        self.memory = memory
+        self.offset = offset
+
+
+class Framegrabber:
+    def __init__(self, config_file, board):
+        self.config_file = config_file
+        self.board = board
+        self.parameters = dict(DEFAULT_PARAMETERS)
+        self.error = ''
+        self.last = 0
+        self.active = False
+        self.memory = None
+        self.thread = None
+        self.frames_behind = 0
+        self.condition = threading.Condition()
+        self.stopping = threading.Event()
+        self.scene_options = {}
+
+    def _grab(self, numpics, memory):
+        width = self.parameters[FG_WIDTH]
+        height = self.parameters[FG_HEIGHT]
+        fps = self.parameters[FG_FRAMESPERSEC]
+        scene = Scene(width, height, **self.scene_options)
+        t0 = time.perf_counter()
+        n = 0
+        while not self.stopping.is_set() and (numpics == GRAB_INFINITE or n < numpics):
+            wait = t0 + (n + 1) / fps - time.perf_counter()
+            if wait > 0:
+                self.stopping.wait(wait)
+                if self.stopping.is_set():
+                    break
+            else:
+                self.frames_behind = max(self.frames_behind, int(-wait * fps))
+            n += 1
+            offset = ((n - 1) % memory.numbuffers) * memory.subsize
+            scene.draw(n, memory.array[offset:offset + width * height].reshape(height, width))
+            with self.condition:
+                self.last = n
+                self.condition.notify_all()
+
+        with self.condition:
+            self.active = False
+            self.condition.notify_all()
+
+
+def Fg_InitConfig(config_file, board):
+    return Framegrabber(config_file, board)
+
+
+def Fg_loadConfig(fg, config_file):
+    fg.config_file = config_file
+    return FG_OK
+
+
+def Fg_saveConfig(fg, config_file):
+    return FG_OK
+
+
+def Fg_FreeGrabber(fg):
+    Fg_stopAcquire(fg, 0)
+    return FG_OK
+
+
+def Fg_setParameterWithInt(fg, parameter, value, port):
+    fg.parameters[parameter] = int(value)
+    return FG_OK
+
+
+def Fg_getParameterWithInt(fg, parameter, port):
+    return FG_OK, fg.parameters[parameter]
+
+
+def Fg_getLastErrorDescription(fg):
+    return fg.error
+
+
+def Fg_AllocMemEx(fg, size, numbuffers):
+    return MemoryHandle(int(size), int(numbuffers))
+
+
+def Fg_FreeMemEx(fg, memory):
+    return FG_OK
+
+
+def Fg_AcquireEx(fg, port, numpics, flags, memory):
+    if fg.active:
+        fg.error = 'acquisition already running'
+        return FG_TRANSFER_NOT_ACTIVE
+    if memory.subsize < fg.parameters[FG_WIDTH] * fg.parameters[FG_HEIGHT]:
+        fg.error = 'buffer too small for the ROI'
+        return FG_TRANSFER_NOT_ACTIVE
+    fg.stopping.clear()
+    fg.last = 0
+    fg.frames_behind = 0
+    fg.active = True
+    fg.memory = memory
+    fg.thread = threading.Thread(target=fg._grab, args=(numpics, memory), daemon=True)
+    fg.thread.start()
+    return FG_OK
+
+
+def Fg_stopAcquire(fg, port):
+    fg.stopping.set()
+    if fg.thread is not None and fg.thread is not threading.current_thread():
+        fg.thread.join()
+    return FG_OK
+
+
+def Fg_getLastPicNumberEx(fg, port, memory):
+    return fg.last
+
+
+def Fg_getLastPicNumberBlockingEx(fg, picnr, port, timeout, memory):
+    with fg.condition:
+        fg.condition.wait_for(lambda: fg.last >= picnr or not fg.active, timeout)
+        if fg.last >= picnr:
+            return fg.last
+        if not fg.active:
+            fg.error = 'acquisition is not running'
+            return FG_TRANSFER_NOT_ACTIVE
+        fg.error = 'timeout'
+        return FG_TIMEOUT_ERR
+
+
+def Fg_getImagePtrEx(fg, picnr, port, memory):
+    return ImagePtr(memory, ((int(picnr) - 1) % memory.numbuffers) * memory.subsize)
+
+
+def getArrayFrom(ptr, width, height):
+    return ptr.memory.array[ptr.offset:ptr.offset + width * height].reshape(height, width)
+
+
+## display calls, nothing is drawn
+
+def CreateDisplay(bits, width, height):
+    return {'bits': bits, 'width': width, 'height': height, 'drawn': 0}
+
+
+def SetBufferWidth(display, width, height):
+    display['width'] = width
+    display['height'] = height
+
+
+def DrawBuffer(display, ptr, picnr, name):
+    display['drawn'] += 1
+
+
+def CloseDisplay(display):
+    return FG_OK
+
+
+def simulate_cam_commands(fg, filename):
+    '''
+    Applies the camera commands in filename (as written by CameraSettings) to the simulated
+    framegrabber. Returns the reply lines of the camera, none for the simulator.
+    '''
+    with open(filename) as fin:
+        for line in fin:
+            match = re.match(r'#([reR])\(([-\d,]+)\)', line.strip())
+            if match is None:
+                continue
+            values = [int(value) for value in match.group(2).split(',')]
+            if match.group(1) == 'r':
+                fg.parameters[FG_FRAMESPERSEC] = values[0]
+            elif match.group(1) == 'e':
+                fg.parameters[FG_EXPOSURE] = values[0]
+            elif len(values) == 4:
+                fg.parameters.update({FG_XOFFSET: values[0], FG_YOFFSET: values[1],
+                                      FG_WIDTH: values[2], FG_HEIGHT: values[3]})
+    return []
+
+
+def main():
+    import argparse
+    from microscope import siso_sim as siso
+    from microscope.camera_buffer import FrameBuffer, AcquisitionThread
+    from microscope.camera_recorder import StreamRecorder
+    from microscope.raw_video import raw_writer
+
+    parser = argparse.ArgumentParser(description='Load test the acquisition and saving path on the simulator')
+    parser.add_argument('--fps', type=int, default=400)
+    parser.add_argument('--numpics', type=int, default=2000)
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=1024)
+    parser.add_argument('--numpicsbuffer', type=int, default=1000)
+    parser.add_argument('--output', default='siso_sim.npy', help='.npy or .h5 file to stream to')
+    args = parser.parse_args()
+
+    ## the simulator is imported by name, so it is the same module camera_buffer calls when this file runs as __main__
+    fg = siso.Fg_InitConfig('simulated.mcf', 0)
+    siso.Fg_setParameterWithInt(fg, siso.FG_WIDTH, args.width, 0)
+    siso.Fg_setParameterWithInt(fg, siso.FG_HEIGHT, args.height, 0)
+    siso.Fg_setParameterWithInt(fg, siso.FG_FRAMESPERSEC, args.fps, 0)
+    memory = siso.Fg_AllocMemEx(fg, args.width * args.height * args.numpicsbuffer, args.numpicsbuffer)
+    buffer = FrameBuffer(fg, memory, args.width, args.height, args.numpicsbuffer, siso=siso)
+    recorder = StreamRecorder(buffer, raw_writer(args.output, (args.height, args.width)), stopframe=args.numpics)
+    acquisition = AcquisitionThread(fg, memory, args.numpics, siso=siso)
+    acquisition.subscribe(recorder.notify)
+
+    t = time.perf_counter()
+    recorder.start()
+    siso.Fg_AcquireEx(fg, 0, args.numpics, siso.ACQ_STANDARD, memory)
+    acquisition.start()
+    acquisition.join()
+    recorder.stop()
+    elapsed = time.perf_counter() - t
+    print(args.numpics, 'frames at', round(args.numpics / elapsed, 1), 'fps (asked for', args.fps, '), simulator',
+          fg.frames_behind, 'frames behind at worst')
+
+
+if __name__ == '__main__':
+    main()
@@ -7,11 +7,17 @@ class VideoCutter(VideoViewer):
         self.cam = cam
         self.framenum = 1
         VideoViewer.__init__(self, parent, filename=filename)
-        self.selector.start_callback(1)
-        self.selector.stop_callback(self.cam.camset.cam_dict['numpicsbuffer'][2])
+        if self.cam.trigger_window is not None and self.cam.holds(*self.cam.trigger_window):
+            # Select exactly the frames kept around the last trigger, unless they have been overwritten since
+            self.selector.start_callback(self.cam.trigger_window[0])
+            self.selector.stop_callback(self.cam.trigger_window[1])
+        else:
+            first, last = self.cam.frame_range()
+            self.selector.start_callback(first)
+            self.selector.stop_callback(last)
 
     def load_vid(self):
-        return 1, self.cam.camset.cam_dict['numpicsbuffer'][2]
+        return self.cam.frame_range()
 
     def load_frame(self):
         pixmap=self.cam.get_pixmap_image(self.framenum)
@@ -0,0 +1,95 @@
+import os
+import subprocess
+import time
+from multiprocessing import get_context, shared_memory
+import numpy as np
+
+from Generic.video import WriteVideo
+
+'''
+Parallel export of frames to compressed video.
+
+fps = export_video(cam.buffer.chunks(1, 1001), 1000, (1024, 1280), '/home/ppzmis/Videos/run.mp4')
+
+The frames are copied once into shared memory, which frees the framegrabber buffer straight
+away. The range is split into chunks of chunkframes frames, each encoded to its own segment
+file by a process pool through Generic.video.WriteVideo. The segments are then joined with
+ffmpeg's concat demuxer, copying the streams without re-encoding.
+'''
+
+
+def _encode_segment(args):
+    name, shape, start, stop, filename = args
+    memory = shared_memory.SharedMemory(name=name)
+    try:
+        frames = np.ndarray(shape, dtype='uint8', buffer=memory.buf)
+        writevid = WriteVideo(filename=filename, frame_size=shape[1:])
+        for frame in frames[start:stop]:
+            writevid.add_frame(frame)
+        writevid.close()
+        del frames
+    finally:
+        memory.close()
+
+    return filename
+
+
+def concat_videos(filenames, output):
+    '''
+    Joins video files with the same encoding into output without re-encoding, using ffmpeg
+    '''
+    listname = output + '.txt'
+    with open(listname, 'w') as fout:
+        for filename in filenames:
+            fout.write("file '" + os.path.abspath(filename) + "'\n")
+    try:
+        subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', listname,
+                        '-c', 'copy', output], check=True)
+    finally:
+        os.remove(listname)
+
+
+def export_video(chunks, numframes, frame_size, filename, processes=None, chunkframes=100):
+    '''
+    Encodes numframes frames, given as an iterable of (n, height, width) arrays such as
+    FrameBuffer.chunks, to filename using a process pool. Returns the frames per second achieved.
+    '''
+    if numframes < 1:
+        raise ValueError('No frames to export')
+    t = time.perf_counter()
+    shape = (numframes,) + tuple(frame_size)
+    memory = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+    base, ext = os.path.splitext(filename)
+    segments = []
+    try:
+        frames = np.ndarray(shape, dtype='uint8', buffer=memory.buf)
+        position = 0
+        for chunk in chunks:
+            frames[position:position + len(chunk)] = chunk
+            position += len(chunk)
+        if position != numframes:
+            raise ValueError(str(position) + ' frames given, expected ' + str(numframes))
+        del frames
+
+        jobs = [(memory.name, shape, start, min(start + chunkframes, numframes),
+                 base + '_part' + str(i).zfill(4) + ext)
+                for i, start in enumerate(range(0, numframes, chunkframes))]
+        # forkserver workers, a fork of the camera process could inherit locks held by its acquisition and Qt threads
+        with get_context('forkserver').Pool(processes) as pool:
+            for segment in pool.imap(_encode_segment, jobs):
+                segments.append(segment)
+
+        if len(segments) == 1:
+            os.replace(segments.pop(), filename)
+        else:
+            concat_videos(segments, filename)
+    finally:
+        memory.close()
+        memory.unlink()
+        for segment in segments:
+            if os.path.exists(segment):
+                os.remove(segment)
+
+    fps = numframes / (time.perf_counter() - t)
+    print('exported', numframes, 'frames to', filename, 'at', round(fps, 1), 'frames per second')
+    return fps